@@ -0,0 +1,221 @@
+import io
+import sys
+import time
+import asyncio
+import collections
+import contextlib
+import http.client
+import email.utils
+from http import HTTPStatus
+
+# Files up to this size are kept in the hot cache, and sent from memory.
+# Larger ones are sent with sendfile.
+HOT_MAX_SIZE = 64 * 1024
+
+# The limits of the hot cache: total size in bytes, and number of files.
+HOT_CACHE_BYTES = 16 * 1024 * 1024
+HOT_CACHE_ENTRIES = 1024
+
+# Close keep-alive connections which are idle for this long, in seconds.
+KEEPALIVE_TIMEOUT = 15
+
+# The longest request line plus headers we accept.
+MAX_HEAD_SIZE = 65536
+
+class HotCache:
+    """An LRU cache of small files (which, in practice, means the pages
+    that get requested a lot: the front page, the feeds, and so on).
+
+    Entries are keyed by (path, size, mtime), as stat()ed by
+    FileSite.respond() for each request. When a build changes a file,
+    the key changes, and the old entry just ages out. The least recently used
+    entries are dropped when the cache exceeds maxbytes or maxentries.
+    """
+    def __init__(self, maxbytes=HOT_CACHE_BYTES, maxentries=HOT_CACHE_ENTRIES):
+        self.maxbytes = maxbytes
+        self.maxentries = maxentries
+        self.map = collections.OrderedDict()
+        self.total = 0
+
+    def get(self, key):
+        data = self.map.get(key)
+        if data is not None:
+            self.map.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        if key in self.map:
+            self.total -= len(self.map.pop(key))
+        self.map[key] = data
+        self.total += len(data)
+        while self.map and (self.total > self.maxbytes or len(self.map) > self.maxentries):
+            _, old = self.map.popitem(last=False)
+            self.total -= len(old)
+
+class AsyncFileServer:
+    """An asyncio HTTP/1.1 server for the destination directory. This is
+    an alternative to servesite.py's threaded server, for load testing
+    with many concurrent clients.
+
+    Requests are answered by a FileSite, exactly as in the threaded
+    server: clean URLs, compressed siblings, ETags, 304s, and
+    Cache-Control. Small files are served from a HotCache, and large
+    ones go out with loop.sendfile(), which is zero-copy where the
+    platform allows.
+
+    Only GET and HEAD are supported. The FileSite does its (brief) disk
+    access synchronously, in the event loop.
+    """
+    def __init__(self, site, hotcache=None):
+        self.site = site
+        self.hotcache = hotcache if hotcache is not None else HotCache()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port, limit=MAX_HEAD_SIZE)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), KEEPALIVE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+                    break
+                if not await self.request(head, reader, writer):
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # The client went away mid-request.
+            pass
+        finally:
+            writer.close()
+            with contextlib.suppress(Exception):
+                await writer.wait_closed()
+
+    async def request(self, head, reader, writer):
+        """Handle one request. Returns True if the connection should be
+        kept open for another.
+        """
+        requestline, _, rest = head.partition(b'\r\n')
+        requestline = requestline.decode('latin-1')
+        ls = requestline.split()
+        if len(ls) != 3 or not ls[2].startswith('HTTP/'):
+            await self.senderror(writer, requestline, 400, False, False)
+            return False
+        method, target, version = ls
+        try:
+            headers = http.client.parse_headers(io.BytesIO(rest))
+        except http.client.HTTPException:
+            await self.senderror(writer, requestline, 400, False, False)
+            return False
+
+        conn = headers.get('Connection', '').lower()
+        if version == 'HTTP/1.1':
+            keepalive = (conn != 'close')
+        else:
+            keepalive = (conn == 'keep-alive')
+
+        # We don't want a request body, but we have to get past it.
+        try:
+            bodylen = int(headers.get('Content-Length', 0))
+        except ValueError:
+            bodylen = -1
+        if bodylen < 0:
+            await self.senderror(writer, requestline, 400, False, False)
+            return False
+        while bodylen > 0:
+            data = await reader.readexactly(min(bodylen, MAX_HEAD_SIZE))
+            bodylen -= len(data)
+
+        if method not in ('GET', 'HEAD'):
+            await self.senderror(writer, requestline, 501, method == 'HEAD', keepalive)
+            return keepalive
+        sendbody = (method == 'GET')
+
+        res = self.site.respond(target, headers)
+        if res.status == 404:
+            await self.senderror(writer, requestline, 404, not sendbody, keepalive)
+            return keepalive
+        if res.status != 200:
+            resheaders = list(res.headers)
+            if res.status != 304:
+                resheaders.append( ('Content-Length', '0') )
+            writer.write(self.responsehead(res.status, resheaders, keepalive))
+            await writer.drain()
+            self.log(writer, requestline, res.status)
+            return keepalive
+
+        key = (res.sendpath, res.sendstat.st_size, res.sendstat.st_mtime)
+        data = None
+        if res.sendstat.st_size <= HOT_MAX_SIZE:
+            data = self.hotcache.get(key)
+        if data is not None:
+            await self.senddata(writer, res, data, sendbody, keepalive)
+        else:
+            try:
+                fl, size = self.site.openbody(res)
+            except OSError:
+                await self.senderror(writer, requestline, 404, not sendbody, keepalive)
+                return keepalive
+            try:
+                if size <= HOT_MAX_SIZE:
+                    data = fl.read()
+                    self.hotcache.put(key, data)
+                    await self.senddata(writer, res, data, sendbody, keepalive)
+                else:
+                    resheaders = list(res.headers)
+                    resheaders.append( ('Content-Length', str(size)) )
+                    writer.write(self.responsehead(200, resheaders, keepalive))
+                    await writer.drain()
+                    if sendbody:
+                        await asyncio.get_running_loop().sendfile(writer.transport, fl, 0, size)
+            finally:
+                fl.close()
+        self.log(writer, requestline, 200)
+        return keepalive
+
+    async def senddata(self, writer, res, data, sendbody, keepalive):
+        resheaders = list(res.headers)
+        resheaders.append( ('Content-Length', str(len(data))) )
+        writer.write(self.responsehead(200, resheaders, keepalive))
+        if sendbody:
+            writer.write(data)
+        await writer.drain()
+
+    async def senderror(self, writer, requestline, status, headonly, keepalive):
+        phrase = HTTPStatus(status).phrase
+        body = ('<html><head><title>%d %s</title></head><body><h1>%d %s</h1></body></html>\n' % (status, phrase, status, phrase,)).encode('utf-8')
+        resheaders = [
+            ('Content-Type', 'text/html;charset=utf-8'),
+            ('Content-Length', str(len(body))),
+        ]
+        writer.write(self.responsehead(status, resheaders, keepalive))
+        if not headonly:
+            writer.write(body)
+        await writer.drain()
+        self.log(writer, requestline, status)
+
+    def responsehead(self, status, headers, keepalive):
+        ls = [
+            'HTTP/1.1 %d %s' % (status, HTTPStatus(status).phrase,),
+            'Server: bloggor',
+            'Date: %s' % (email.utils.formatdate(usegmt=True),),
+        ]
+        for key, val in headers:
+            ls.append('%s: %s' % (key, val,))
+        ls.append('Connection: %s' % ('keep-alive' if keepalive else 'close',))
+        return ('\r\n'.join(ls) + '\r\n\r\n').encode('latin-1')
+
+    def log(self, writer, requestline, status):
+        # The same format as http.server.
+        peer = writer.get_extra_info('peername')
+        host = (peer[0] if peer else '-')
+        val = time.strftime('%d/%b/%Y %H:%M:%S')
+        sys.stderr.write('%s - - [%s] "%s" %d -\n' % (host, val, requestline, status,))
+
+def run(site, host, port):
+    server = AsyncFileServer(site)
+    try:
+        asyncio.run(server.serve(host, port))
+    except KeyboardInterrupt:
+        print()
@@ -0,0 +1,137 @@
+import os
+import os.path
+import json
+import hashlib
+import markdown
+
+# Bump this if the format of cached data changes.
+CACHE_VERSION = 1
+
+class ReadCache:
+    """A persistent cache of converted source files. Each entry is keyed
+    by the file's inpath, and records the file's mtime, size, and content
+    hash, plus the data that read() derived from it.
+
+    The whole cache is thrown away if the fingerprint (Markdown extensions
+    and config) changes.
+    """
+    def __init__(self, ctx, path):
+        self.ctx = ctx
+        self.path = path
+        self.fingerprint = cachefingerprint(ctx)
+        self.map = {}
+        self.seen = set()
+        self.hits = 0
+        self.misses = 0
+        # Set when the map has changes which haven't been saved.
+        self.dirty = False
+
+    def load(self):
+        self.map = {}
+        try:
+            fl = open(self.path)
+        except FileNotFoundError:
+            return
+        try:
+            dat = json.load(fl)
+        except ValueError:
+            print('Cache file is corrupt; ignoring it')
+            return
+        finally:
+            fl.close()
+        if dat.get('fingerprint') != self.fingerprint:
+            print('Configuration has changed; discarding cache')
+            return
+        self.map = dat.get('entries', {})
+
+    def prune(self):
+        # Drop entries for files that weren't seen this run (deleted or
+        # renamed).
+        ls = [ key for key in self.map if key not in self.seen ]
+        for key in ls:
+            del self.map[key]
+        if ls:
+            self.dirty = True
+
+    def save(self):
+        self.prune()
+        dat = {
+            'fingerprint': self.fingerprint,
+            'entries': self.map,
+        }
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temppath = self.path + '_tmp'
+        fl = open(temppath, 'w')
+        json.dump(dat, fl)
+        fl.close()
+        os.replace(temppath, self.path)
+        self.dirty = False
+
+    def has(self, key, path, stat):
+        """Check whether get() will succeed, without counting it as
+        a hit or miss.
+        """
+        ent = self.map.get(key)
+        if ent is None or ent['size'] != stat.st_size:
+            return False
+        if ent['mtime'] != stat.st_mtime:
+            if ent['hash'] != filehash(path):
+                return False
+            # Touched but not changed. Record the new mtime, so that we
+            # don't hash it again next time.
+            ent['mtime'] = stat.st_mtime
+            self.dirty = True
+        return True
+
+    def get(self, key, path, stat):
+        """Return the cached data for a source file, or None if the
+        file has changed (or was never cached).
+        """
+        self.seen.add(key)
+        if not self.has(key, path, stat):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.map[key]['data']
+
+    def put(self, key, path, stat, data):
+        self.seen.add(key)
+        self.dirty = True
+        self.map[key] = {
+            'mtime': stat.st_mtime,
+            'size': stat.st_size,
+            'hash': filehash(path),
+            'data': data,
+        }
+
+    def report(self):
+        return 'Cache: %d hits, %d misses' % (self.hits, self.misses,)
+
+
+def filehash(path):
+    with open(path, 'rb') as fl:
+        return hashlib.sha1(fl.read()).hexdigest()
+
+def cachefingerprint(ctx):
+    """Generate a string which changes whenever the conversion of source
+    files might change.
+    """
+    extlist = bloggor.mdextension.extension_list(serverurl=ctx.serverurl)
+    names = []
+    for ext in extlist:
+        if isinstance(ext, str):
+            names.append(ext)
+        else:
+            names.append(ext.__class__.__name__)
+    ls = [
+        'v%d' % (CACHE_VERSION,),
+        'markdown %s' % (markdown.__version__,),
+        ','.join(names),
+        filehash(bloggor.mdextension.__file__),
+    ]
+    for key, val in sorted(ctx.config.items()):
+        ls.append('%s=%s' % (key, val,))
+    return hashlib.sha1('\n'.join(ls).encode()).hexdigest()
+
+
+import bloggor.mdextension
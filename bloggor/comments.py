@@ -12,6 +12,7 @@ class CommentThread:
         assert filename.endswith('.comments')
 
         self.path = os.path.join(self.dirpath, self.filename)
+        self.inpath = os.path.relpath(self.path, start=ctx.opts.srcdir)
         self.outpath = os.path.relpath(self.path, start=ctx.entriesdir)
         self.outuri = self.outpath[ : -9]
         self.entry = None
@@ -26,19 +27,22 @@ class CommentThread:
         return '<%s "%s" (%d)>' % (self.__class__.__name__, self.outuri, len(self.comments))
 
     def read(self):
-        mfl = MultiMetaFile(self.path)
-        ls = mfl.read()
+        if self.path in self.ctx.prefetched:
+            ls, error = self.ctx.prefetched.pop(self.path)
+        else:
+            ls, error = readcommentfile(self.path, self.outuri, self.ctx.mdenv)
 
         # Note that hidden comments will appear in self.fediids but not in self.comments.
         idls = []
         
-        for ix, mf in enumerate(ls):
-            body, meta = mf.read()
+        for ix, (body, meta) in enumerate(ls):
             com = Comment(self.ctx, self, ix, body, meta)
             if com.fediid:
                 idls.append(com.fediid)
             if not com.hidden:
                 self.comments.append(com)
+        if error:
+            raise error
 
         if idls:
             self.fediids = idls
@@ -49,40 +53,17 @@ class CommentThread:
             self.longlatestpublished = relativetime(self.latestpublished, self.entry.published)
             self.shortlatestpublished = relativetime(self.latestpublished, self.entry.published, english=False)
 
-        stat = os.stat(self.path)
+        stat = self.ctx.statfile(self.path)
         self.inmodtime = stat.st_mtime
 
         self.entry.addcomments(self)
         
 class Comment:
     def __init__(self, ctx, thread, index, body, meta):
+        # The body has already been converted by convertcomment().
         self.thread = thread
-        self.id = '%s[%d]' % (thread.outuri, index,)
-
-        body = body.rstrip() + '\n'
-
-        ls = meta.get('format')
-        if not ls:
-            format = FileType.TXT
-        else:
-            try:
-                val = ''.join(ls)
-                format = parse_filetype(val)
-            except ValueError:
-                raise RuntimeException(self.id+': unknown comment format: '+val)
-            
-        if format == FileType.TXT:
-            val = str(markupsafe.escape(body))
-            self.body = '<div class="PreWrapAll">\n%s</div>' % (val,)
-        elif format == FileType.HTML:
-            self.body = body
-        elif format == FileType.WHTML:
-            self.body = '<div class="PreWrapAll">\n%s</div>' % (body,)
-        elif format == FileType.MD:
-            ctx.mdenv.reset()
-            self.body = ctx.mdenv.convert(body)
-        else:
-            raise RuntimeException(self.id+': unknown comment format: '+format)
+        self.id = commentid(thread.outuri, index)
+        self.body = body
 
         self.source = None
         self.fediid = None
@@ -187,6 +168,56 @@ class Attachment:
         return '<%s "%s">' % (self.__class__.__name__, self.url)
 
 
+def commentid(outuri, index):
+    return '%s[%d]' % (outuri, index,)
+
+def convertcomment(id, body, meta, mdenv):
+    """Convert a comment body to HTML, according to its format field.
+    """
+    body = body.rstrip() + '\n'
+
+    ls = meta.get('format')
+    if not ls:
+        format = FileType.TXT
+    else:
+        try:
+            val = ''.join(ls)
+            format = parse_filetype(val)
+        except ValueError:
+            raise RuntimeException(id+': unknown comment format: '+val)
+        
+    if format == FileType.TXT:
+        val = str(markupsafe.escape(body))
+        return '<div class="PreWrapAll">\n%s</div>' % (val,)
+    elif format == FileType.HTML:
+        return body
+    elif format == FileType.WHTML:
+        return '<div class="PreWrapAll">\n%s</div>' % (body,)
+    elif format == FileType.MD:
+        mdenv.reset()
+        return mdenv.convert(body)
+    else:
+        raise RuntimeException(id+': unknown comment format: '+format)
+
+def readcommentfile(path, outuri, mdenv):
+    """Read a comments file and convert the comment bodies.
+    Returns (ls, error), where ls is a list of (body, meta) pairs. If a
+    comment could not be converted, ls stops short and error is the
+    exception. (We don't raise it right away, because the comments before
+    it might have errors which should be reported first.)
+    """
+    mfl = MultiMetaFile(path)
+    ls = []
+    for ix, mf in enumerate(mfl.read()):
+        body, meta = mf.read()
+        try:
+            body = convertcomment(commentid(outuri, ix), body, meta, mdenv)
+        except RuntimeException as ex:
+            return ls, ex
+        ls.append( (body, meta) )
+    return ls, None
+
+
 from bloggor.constants import FileType, parse_filetype, eastern_tz
 from bloggor.metafile import MultiMetaFile, ls_as_value, ls_as_bool
 from bloggor.excepts import RuntimeException
@@ -0,0 +1,134 @@
+import os
+import os.path
+import gzip
+import hashlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# The encodings we can precompress with, and the suffix of the sibling
+# file for each. In order of preference, when a client accepts several.
+encoding_suffixes = [
+    ('br', '.br'),
+    ('gzip', '.gz'),
+]
+
+def parseencodings(val):
+    """Parse the compress config value: "no", or a list of encodings
+    ("gzip", "br"). Returns a list of encodings.
+    """
+    val = val.strip().lower()
+    if val in ('', 'no', 'none', 'false'):
+        return []
+    known = [ enc for enc, suffix in encoding_suffixes ]
+    res = []
+    for enc in val.split(','):
+        enc = enc.strip()
+        if enc == 'brotli':
+            enc = 'br'
+        if enc not in known:
+            raise RuntimeException('compress: unknown encoding: '+enc)
+        if enc == 'br' and brotli is None:
+            raise RuntimeException('compress: the brotli module is not installed')
+        if enc not in res:
+            res.append(enc)
+    return res
+
+def compressdata(encoding, data):
+    if encoding == 'gzip':
+        # mtime=0 so that the same page always compresses the same way.
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    if encoding == 'br':
+        return brotli.compress(data)
+    raise RuntimeException('unknown encoding: '+encoding)
+
+def siblingsmatch(path, encodings):
+    """Check whether the compressed siblings of path are exactly the
+    ones that encodings calls for.
+    """
+    for enc, suffix in encoding_suffixes:
+        if os.path.exists(path+suffix) != (enc in encodings):
+            return False
+    return True
+
+def siblingsfresh(path, encodings):
+    """Check whether the compressed siblings of path are exactly the
+    ones that encodings calls for, and none of them is older than path.
+    If so, they were written from the current contents.
+    """
+    try:
+        mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        return False
+    for enc, suffix in encoding_suffixes:
+        try:
+            sibmtime = os.stat(path+suffix).st_mtime
+        except FileNotFoundError:
+            sibmtime = None
+        if (sibmtime is not None) != (enc in encodings):
+            return False
+        if sibmtime is not None and sibmtime < mtime:
+            return False
+    return True
+
+def processoutput(path, encodings, oldhash=None):
+    """Hash an output file, and write its compressed siblings (removing
+    any for encodings that are no longer wanted). If the hash matches
+    oldhash and the siblings are in place, they're left alone. Returns
+    the hash.
+
+    Siblings are written to a temp file and renamed, never written in
+    place, so this is safe for --atomic builds.
+    """
+    with open(path, 'rb') as fl:
+        data = fl.read()
+    hash = hashlib.sha1(data).hexdigest()
+    if oldhash is not None and hash == oldhash and siblingsmatch(path, encodings):
+        return hash
+    for enc, suffix in encoding_suffixes:
+        sibpath = path+suffix
+        if enc not in encodings:
+            if os.path.exists(sibpath):
+                os.remove(sibpath)
+            continue
+        temppath = sibpath + '_tmp'
+        with open(temppath, 'wb') as fl:
+            fl.write(compressdata(enc, data))
+        os.replace(temppath, sibpath)
+    return hash
+
+def removesiblings(path):
+    for enc, suffix in encoding_suffixes:
+        if os.path.exists(path+suffix):
+            os.remove(path+suffix)
+
+def chooseencoding(accept, available):
+    """Given an Accept-Encoding header and a list of the encodings on
+    hand, return the one to use, or None.
+    """
+    if not accept or not available:
+        return None
+    qvals = {}
+    for val in accept.split(','):
+        enc, _, params = val.partition(';')
+        enc = enc.strip().lower()
+        qval = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                qval = float(params[2:])
+            except ValueError:
+                qval = 0.0
+        qvals[enc] = qval
+    for enc, suffix in encoding_suffixes:
+        if enc not in available:
+            continue
+        qval = qvals.get(enc, qvals.get('*', 0.0))
+        if qval > 0:
+            return enc
+    return None
+
+
+from bloggor.excepts import RuntimeException
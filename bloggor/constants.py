@@ -16,6 +16,7 @@ def parse_filetype(val):
 class FeedType(Enum):
     RSS = 'rss'
     ATOM = 'atom'
+    JSON = 'json'
 
 class Depend(IntFlag):
     NONE     = 0
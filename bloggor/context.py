@@ -1,37 +1,121 @@
 import os
 import os.path
 import time
+import optparse
 import configparser
 import markdown
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, select_autoescape
 
 from bloggor.constants import FeedType, Depend
 from bloggor.excepts import RuntimeException
 from bloggor.util import MultiDict
 from bloggor.util import parsespecs, parsedate, parseinterval
-from bloggor.util import xofypages
+from bloggor.util import xofypages, sizestr
 from bloggor.util import urltohost
 from bloggor.pages import FrontPage
 from bloggor.pages import EntryPage, GenTemplatePage, StaticPage
 from bloggor.pages import TagListPage, TagListFreqPage, TagPage
 from bloggor.pages import RecentEntriesPage, YearEntriesPage, MonthEntriesPage
 from bloggor.pages import HistoryPage
-from bloggor.pages import FeedPage
-from bloggor.pages import PageSet
+from bloggor.pages import FeedPage, TagFeedPage, YearFeedPage
+from bloggor.pages import PageSet, PageIndex
+from bloggor.pages import paginate
 from bloggor.comments import CommentThread
+from bloggor.cache import ReadCache, filehash
+from bloggor.scan import Snapshot
+from bloggor.manifest import Manifest, MANIFEST_NAME
+from bloggor.generations import Generations
+from bloggor.depgraph import DependGraph
+from bloggor.manifest import entrysnapshot, snapshotdiff, pagedeps, buildfingerprint
+from bloggor.workers import canfork, chunksize
+from bloggor.workers import readpool, readsourcetask, readcommentstask
+from bloggor.workers import buildpool, buildtask, partition
+from bloggor.workers import compresspool, compresstask
+from bloggor.compress import parseencodings, siblingsfresh, removesiblings
 import bloggor.jextension
 import bloggor.mdextension
 
+# How many of the largest pages to list after a build.
+REPORT_LARGEST = 3
+
+# The options that build.py would supply if run with no arguments.
+default_opts = {
+    'srcdir': 'src',
+    'configfile': None,
+    'destdir': 'site',
+    'cachedir': None,
+    'nocache': None,
+    'jobs': 1,
+    'buildall': None,
+    'recent': None,
+    'buildonly': None,
+    'longlist': None,
+    'watch': None,
+    'atomic': None,
+    'dryrun': None,
+    'nocommit': None,
+    'notemp': None,
+}
+
+def defaultopts(**kwargs):
+    """Create an options object for a Context, for callers other than
+    build.py. Keyword arguments override the defaults.
+    """
+    opts = optparse.Values(default_opts)
+    for key, val in kwargs.items():
+        setattr(opts, key, val)
+    return opts
+
+def skipsrcfile(filename, entry=False):
+    """Return True for files in the source directories which aren't
+    source files.
+    """
+    if filename.startswith('.'):
+        return True
+    if filename.endswith('~'):
+        return True
+    if entry:
+        if filename.endswith('.json'):
+            return True
+        if filename.endswith('.notes'):
+            return True
+    return False
+
 class Context:
     def __init__(self, opts):
         self.opts = opts
         
         self.config = self.readconfig()
         self.serverurl = self.config['serverurl']
+
+        # Tag, year, and month pages with more entries than this are
+        # split into several pages. (Zero means never.)
+        try:
+            self.pagesize = int(self.config['pagesize'])
+        except ValueError:
+            raise RuntimeException('pagesize must be a number')
+
+        # Whether to generate a feed for each tag, and for each year.
+        try:
+            self.tagfeeds = self.config.getboolean('tagfeeds')
+            self.yearfeeds = self.config.getboolean('yearfeeds')
+        except ValueError:
+            raise RuntimeException('tagfeeds and yearfeeds must be yes or no')
+
+        # Compressed versions of each output file to write alongside it.
+        self.encodings = parseencodings(self.config['compress'])
         
         self.entriesdir = os.path.join(self.opts.srcdir, 'entries')
         self.pagesdir = os.path.join(self.opts.srcdir, 'pages')
 
+        # Where pages are written. During an --atomic build, this is
+        # the staging directory.
+        self.destdir = self.opts.destdir
+
+        self.cachedir = self.opts.cachedir
+        if not self.cachedir:
+            self.cachedir = os.path.join(self.opts.srcdir, '.bloggor-cache')
+
         self.errors = None
         
         self.pages = []
@@ -46,31 +130,68 @@ class Context:
         self.entriesbytag = MultiDict()
         self.entriesbyyear = MultiDict()
         self.entriesbymonth = MultiDict()
+        # Tags used by more than one entry, sorted.
+        self.commontags = []
         self.recentyears = []
         self.recententries = []
         self.recentfew = []
         
-        self.jenv = Environment(
+        self.jenv = self.createjenv()
+
+        extlist = bloggor.mdextension.extension_list(serverurl=self.serverurl)
+        self.mdenv = markdown.Markdown(extensions=extlist)
+
+        # Set when we're doing a full or automatic build.
+        self.manifest = None
+        self.writesmanifest = False
+        self.sourcerecords = None
+        self.orphans = []
+
+        # Set up by addnonsrc() and computedepends().
+        self.pageindex = None
+        self.depgraph = None
+
+        # Source files converted by worker processes, by path.
+        self.prefetched = {}
+
+        # The stat information for the source files; see readsrc().
+        self.snapshot = None
+
+        self.readcache = None
+        if not self.opts.nocache:
+            self.readcache = ReadCache(self, os.path.join(self.cachedir, 'readcache.json'))
+
+    def createjenv(self):
+        # Compiled templates are cached, so that a run doesn't have to
+        # re-parse the templates it uses. Jinja checks each cached
+        # entry against the template source, so edits invalidate it.
+        bytecodecache = None
+        if not self.opts.nocache:
+            tempcachedir = os.path.join(self.cachedir, 'templates')
+            os.makedirs(tempcachedir, exist_ok=True)
+            bytecodecache = FileSystemBytecodeCache(tempcachedir)
+        
+        jenv = Environment(
             loader = FileSystemLoader(os.path.join(self.opts.srcdir, 'templates')),
+            bytecode_cache = bytecodecache,
             extensions = [
                 bloggor.jextension.TagFilename,
                 bloggor.jextension.SplitAtMore,
                 bloggor.jextension.CommentDepthStep,
+                bloggor.jextension.FragmentCache,
             ],
             autoescape = select_autoescape(),
             keep_trailing_newline = True,
         )
-        self.jenv.globals['blogctx'] = self
-        self.jenv.globals['serverurl'] = self.serverurl
-        self.jenv.globals['servername'] = urltohost(self.serverurl)
-        self.jenv.globals['blogtitle'] = self.config['blogtitle']
-        self.jenv.globals['blogsubtitle'] = self.config['blogsubtitle']
-        self.jenv.globals['ownername'] = self.config['ownername']
-        self.jenv.globals['fediserver'] = self.config['fediserver']
-        self.jenv.globals['fediuser'] = self.config['fediuser']
-
-        extlist = bloggor.mdextension.extension_list(serverurl=self.serverurl)
-        self.mdenv = markdown.Markdown(extensions=extlist)
+        jenv.globals['blogctx'] = self
+        jenv.globals['serverurl'] = self.serverurl
+        jenv.globals['servername'] = urltohost(self.serverurl)
+        jenv.globals['blogtitle'] = self.config['blogtitle']
+        jenv.globals['blogsubtitle'] = self.config['blogsubtitle']
+        jenv.globals['ownername'] = self.config['ownername']
+        jenv.globals['fediserver'] = self.config['fediserver']
+        jenv.globals['fediuser'] = self.config['fediuser']
+        return jenv
 
     def readconfig(self):
         configpath = self.opts.configfile
@@ -84,6 +205,10 @@ class Context:
             'serverurl': 'https://blog.example.com/',
             'fediuser': 'username',
             'fediserver': 'mastodon.example.com',
+            'pagesize': '0',
+            'tagfeeds': 'no',
+            'yearfeeds': 'no',
+            'compress': 'no',
         }
         config = configparser.ConfigParser(defaults=defaults)
 
@@ -105,30 +230,70 @@ class Context:
             return False
 
         pagelist = self.filterpages(pagespecs)
-        if not pagelist:
+        if not pagelist and not self.writesmanifest:
             return True
-    
+
+        self.generate(pagelist)
+        return True
+
+    def generate(self, pagelist):
+        """Build and commit the given pages. For full or automatic builds,
+        also remove orphaned pages and update the manifest.
+        """
         if self.opts.dryrun:
             print('Not building %s...' % (xofypages(len(pagelist), len(self.pages)),))
             if len(pagelist) < 20 or self.opts.longlist:
                 for page in pagelist:
                     print('  .../'+page.outpath)
-            return True
+            for outpath in self.orphans:
+                print('Not removing .../'+outpath)
+            return
 
-        self.build(pagelist)
+        if self.opts.atomic and not self.opts.nocommit and (pagelist or self.orphans):
+            self.generateatomic(pagelist)
+            return
 
-        return True
+        if pagelist:
+            self.build(pagelist)
+
+        if self.writesmanifest and not self.opts.nocommit:
+            self.prune()
+            self.writemanifest()
+
+        self.savecache()
+
+    def generateatomic(self, pagelist):
+        """Build into a new generation of the site, and then publish
+        it by swapping the destination symlink. If anything fails, the
+        live site is untouched.
+        """
+        if self.opts.notemp:
+            raise RuntimeException('--atomic cannot be used with --notemp')
+        gens = Generations(self.opts.destdir)
+        self.destdir = gens.begin()
+        try:
+            if pagelist:
+                self.build(pagelist)
+            if self.writesmanifest:
+                self.prune()
+                self.writemanifest()
+            self.savecache()
+        except:
+            gens.abort()
+            raise
+        finally:
+            self.destdir = self.opts.destdir
+        gens.publish()
 
     def readsrc(self):
-        for dirpath, dirnames, filenames in os.walk(self.entriesdir):
+        if self.readcache:
+            self.readcache.load()
+
+        self.snapshot = Snapshot([ self.entriesdir, self.pagesdir ])
+            
+        for dirpath, filenames in self.snapshot.walk(self.entriesdir):
             for filename in filenames:
-                if filename.startswith('.'):
-                    continue
-                if filename.endswith('~'):
-                    continue
-                if filename.endswith('.json'):
-                    continue
-                if filename.endswith('.notes'):
+                if skipsrcfile(filename, entry=True):
                     continue
                 try:
                     if filename.endswith('.html') or filename.endswith('.md') or filename.endswith('.txt'):
@@ -146,11 +311,9 @@ class Context:
                     print('Error: %s' % (ex,))
                     self.errors.append(ex)
 
-        for dirpath, dirnames, filenames in os.walk(self.pagesdir):
+        for dirpath, filenames in self.snapshot.walk(self.pagesdir):
             for filename in filenames:
-                if filename.startswith('.'):
-                    continue
-                if filename.endswith('~'):
+                if skipsrcfile(filename):
                     continue
                 try:
                     if filename.endswith('.html') or filename.endswith('.md') or filename.endswith('.txt'):
@@ -182,6 +345,9 @@ class Context:
         if self.errors:
             return
 
+        if self.opts.jobs > 1:
+            self.prefetch()
+
         print('Reading %d entries plus %d pages...' % (len(self.entries), len(self.pages)-len(self.entries),))
         for page in self.pages:
             try:
@@ -201,6 +367,37 @@ class Context:
         if self.errors:
             return
 
+        self.prefetched.clear()
+
+        if self.readcache:
+            print(self.readcache.report())
+            self.readcache.prune()
+            if self.readcache.dirty:
+                self.readcache.save()
+
+        self.indexentries()
+
+    def statfile(self, path):
+        """Stat a source file, using the snapshot taken by readsrc().
+        """
+        if self.snapshot is None:
+            return os.stat(path)
+        return self.snapshot.stat(path)
+
+    def indexentries(self):
+        """Sort the entries and set up the lists and maps of live entries.
+        This can be called again after entries are added, removed, or
+        re-read; everything is cleared first.
+        """
+        del self.liveentries[:]
+        del self.draftentries[:]
+        self.entriesbytag.clear()
+        self.entriesbyyear.clear()
+        self.entriesbymonth.clear()
+        for page in self.entries:
+            page.index = None
+            page.backdependpages = []
+        
         for page in self.entries:
             if page.live:
                 self.liveentries.append(page)
@@ -229,10 +426,43 @@ class Context:
             for tag in entry.tags:
                 self.entriesbytag.add(tag, entry)
 
+        self.commontags = [ tag for tag, ls in self.entriesbytag.items() if len(ls) > 1 ]
+        self.commontags.sort()
+
         ls = list(self.entriesbyyear.keys())
         ls.sort(reverse=True)
         self.recentyears = ls[ : 5 ]
         
+    def prefetch(self):
+        """Convert source files in a pool of worker processes, ahead of
+        the read() calls. (Files which are in the read cache are skipped.)
+        The results go into self.prefetched, where read() will find them.
+        """
+        if not canfork():
+            print('Cannot fork worker processes; reading serially')
+            return
+
+        srcls = []
+        for page in self.pages:
+            if self.readcache:
+                stat = self.statfile(page.path)
+                if self.readcache.has(page.inpath, page.path, stat):
+                    continue
+            srcls.append(page)
+
+        jobs = self.opts.jobs
+        print('Converting %d files plus %d comment threads with %d jobs...' % (len(srcls), len(self.commentthreads), jobs,))
+        with readpool(jobs, self.serverurl) as pool:
+            args = [ (page.path, page.type) for page in srcls ]
+            results = pool.map(readsourcetask, args, chunksize=chunksize(len(args), jobs))
+            for page, (res, ex) in zip(srcls, results):
+                self.prefetched[page.path] = (ex if ex is not None else res)
+                
+            args = [ (comt.path, comt.outuri) for comt in self.commentthreads ]
+            results = pool.map(readcommentstask, args, chunksize=chunksize(len(args), jobs))
+            for comt, res in zip(self.commentthreads, results):
+                self.prefetched[comt.path] = res
+        
     def addnonsrc(self):
         page = FrontPage(self)
         self.pages.append(page)
@@ -247,12 +477,12 @@ class Context:
         self.pages.append(page)
 
         for year, ls in self.entriesbyyear.items():
-            page = YearEntriesPage(self, year, ls)
-            self.pages.append(page)
+            series = [ YearEntriesPage(self, year, chunkls, chunk=chunk) for chunk, chunkls in paginate(ls, self.pagesize) ]
+            self.addseries(series)
         
         for month, ls in self.entriesbymonth.items():
-            page = MonthEntriesPage(self, month, ls)
-            self.pages.append(page)
+            series = [ MonthEntriesPage(self, month, chunkls, chunk=chunk) for chunk, chunkls in paginate(ls, self.pagesize) ]
+            self.addseries(series)
         
         page = TagListPage(self)
         self.pages.append(page)
@@ -261,8 +491,8 @@ class Context:
         self.pages.append(page)
 
         for tag, ls in self.entriesbytag.items():
-            page = TagPage(self, tag, ls)
-            self.pages.append(page)
+            series = [ TagPage(self, tag, chunkls, chunk=chunk) for chunk, chunkls in paginate(ls, self.pagesize) ]
+            self.addseries(series)
 
         page = FeedPage(self, FeedType.ATOM, 'feeds/posts/default.xml')
         self.pages.append(page)
@@ -270,6 +500,29 @@ class Context:
         page = FeedPage(self, FeedType.RSS, 'feeds/posts/default.rss', withsuffix=True)
         self.pages.append(page)
 
+        page = FeedPage(self, FeedType.JSON, 'feeds/posts/default.json', withsuffix=True)
+        self.pages.append(page)
+
+        if self.tagfeeds:
+            for tag in self.entriesbytag.keys():
+                page = TagFeedPage(self, FeedType.ATOM, tag)
+                self.pages.append(page)
+
+        if self.yearfeeds:
+            for year in self.entriesbyyear.keys():
+                page = YearFeedPage(self, FeedType.ATOM, year)
+                self.pages.append(page)
+
+        self.pageindex = PageIndex(self.pages)
+
+    def addseries(self, series):
+        # The pages of a paginated list (or a single page, if it's
+        # not split).
+        if len(series) > 1:
+            for page in series:
+                page.chunkseries = series
+        self.pages.extend(series)
+
     def filterpages(self, pagespecs):
         recentlimit = None
         if self.opts.recent:
@@ -284,38 +537,49 @@ class Context:
                 print('Ignoring pagespecs, building --all')
             if recentlimit is not None:
                 print('Ignoring --recent, building --all')
+            self.writesmanifest = True
+            if self.loadmanifest():
+                self.findorphans()
             return list(self.pages)
         
         if not pagespecs and recentlimit is None:
-            print('No pages requested')
-            return []
+            return self.autopages()
         
         try:
             pagespecs = parsespecs(pagespecs)
         except ValueError as ex:
             raise RuntimeException(str(ex))
+
+        if recentlimit is not None and self.loadmanifest():
+            # Recently-modified entries will only trigger rebuilds for the
+            # fields that have changed since the last build.
+            if self.manifest.fingerprint == buildfingerprint(self):
+                deps = self.entrychanges()
+                for entry in self.entries:
+                    dep = deps[entry.inpath]
+                    if dep & Depend.PUBDATE:
+                        # The entry may have moved in the order, so
+                        # its neighbors (old and new) need rebuilding.
+                        dep = Depend.ALL
+                    entry.changedep = dep
         
+        pagedeps = self.pageindex.matchspecs(pagespecs, recentlimit)
         if self.opts.buildonly:
-            pagelist = [ page for page in self.pages if page.matchspecs(pagespecs, recentlimit) is not None ]
+            pagelist = [ page for page, dep in pagedeps ]
         else:
-            for page in self.pages:
-                if page.backdependpages:
-                    for backdep, dep in page.backdependpages:
-                        if backdep.dependpages is None:
-                            backdep.dependpages = []
-                        backdep.dependpages.append( (page, dep) )
-            pagedeps = []
-            for page in self.pages:
-                dep = page.matchspecs(pagespecs, recentlimit)
-                if dep is not None:
-                    pagedeps.append( (page, dep) )
+            self.computedepends()
             pageset = PageSet()
             for page, dep in pagedeps:
                 pageset.add(page)
             for page, dep in pagedeps:
-                if page.dependpages:
-                    for page2, dep2 in page.dependpages:
-                        if dep & dep2:
+                for page2 in self.depgraph.dependents(page, dep):
+                    pageset.add(page2)
+                if page.changedep is not None:
+                    # Pages that depended on the entry last time, as
+                    # in autopages().
+                    for outpath, dep2 in self.manifest.outputdeps(page.inpath):
+                        page2 = self.pageindex.byoutpath.get(outpath)
+                        if dep & dep2 and page2 is not None:
                             pageset.add(page2)
             pagelist = list(pageset)
             
@@ -327,29 +591,294 @@ class Context:
             raise RuntimeException('No pages match ' + val)
         return pagelist
 
+    def computedepends(self):
+        self.depgraph = DependGraph(self.pages, self.liveentries)
+
+    def loadmanifest(self):
+        self.manifest = Manifest(os.path.join(self.destdir, MANIFEST_NAME))
+        return self.manifest.load()
+
+    def getsourcerecords(self):
+        """Stat every source file, and hash the ones which might have
+        changed since the manifest was written. Returns a dict
+        { inpath: record }.
+        """
+        if self.sourcerecords is None:
+            self.sourcerecords = {}
+            ls = [ page for page in self.pages if page.inpath is not None ]
+            ls.extend(self.commentthreads)
+            for page in ls:
+                self.sourcerecords[page.inpath] = self.manifest.sourcerecord(page.inpath, page.path, self.statfile(page.path))
+        return self.sourcerecords
+
+    def autopages(self, reload=True):
+        """Work out which pages need rebuilding, by comparing the source
+        files against the manifest of the last build. If reload is false,
+        compare against the manifest already in self.manifest instead of
+        the one on disk.
+        """
+        self.writesmanifest = True
+        if reload and not self.loadmanifest():
+            print('No build manifest; building all pages')
+            return list(self.pages)
+        self.findorphans()
+        
+        man = self.manifest
+        if man.fingerprint != buildfingerprint(self):
+            print('Templates or configuration have changed; building all pages')
+            return list(self.pages)
+
+        records = self.getsourcerecords()
+        
+        deps = self.entrychanges()
+        
+        # List of (inpath, page, dep), where page is None for deleted entries.
+        changes = []
+
+        for page in self.pages:
+            if page.inpath is None:
+                continue
+            old = man.sources.get(page.inpath)
+            changed = (not old or old['hash'] != records[page.inpath]['hash'])
+            if page.inpath in deps:
+                # An entry: its own page must be rebuilt if anything
+                # changed, but other pages only care about certain fields.
+                dep = deps[page.inpath]
+                if changed or dep:
+                    changes.append( (page.inpath, page, dep) )
+            elif changed:
+                changes.append( (page.inpath, page, Depend.ALL) )
+
+        for inpath, snapshot in man.entries.items():
+            if inpath not in records:
+                print('Deleted: %s%s' % (self.serverurl, snapshot['outuri'],))
+                changes.append( (inpath, None, Depend.ALL) )
+
+        self.computedepends()
+        pagesbyoutpath = { page.outpath: page for page in self.pages }
+        pageset = PageSet()
+
+        # Pages which weren't built last time (this covers new tags, years,
+        # and so on), or which now list a different set of entries (this
+        # covers entries moving between the chunks of a split page), or
+        # whose series has changed shape.
+        for page in self.pages:
+            old = man.outputs.get(page.outpath)
+            if not old or old['deps'].keys() != pagedeps(page).keys() or old.get('layout') != page.layout():
+                pageset.add(page)
+
+        for inpath, page, dep in changes:
+            if page is not None:
+                pageset.add(page)
+                for page2 in self.depgraph.dependents(page, dep):
+                    pageset.add(page2)
+            # Pages that depended on the entry last time. (This covers
+            # removed tags, deleted entries, and so on.)
+            for outpath, dep2 in man.outputdeps(inpath):
+                if dep & dep2 and outpath in pagesbyoutpath:
+                    pageset.add(pagesbyoutpath[outpath])
+
+        if not pageset:
+            print('No pages need rebuilding')
+        return list(pageset)
+
+    def savecache(self):
+        # Entry bodies are converted lazily, so building may have added
+        # to the read cache.
+        if self.readcache and self.readcache.dirty:
+            self.readcache.save()
+
+    def getsnapshots(self):
+        records = self.getsourcerecords()
+        res = {}
+        for entry in self.entries:
+            commenthash = None
+            if entry.commentthread:
+                commenthash = records[entry.commentthread.inpath]['hash']
+            res[entry.inpath] = entrysnapshot(entry, records[entry.inpath]['hash'], commenthash)
+        return res
+
+    def entrychanges(self):
+        """Compare every entry against its snapshot in the manifest.
+        Returns a dict { inpath: dep } giving the fields which changed.
+        """
+        snapshots = self.getsnapshots()
+        res = {}
+        for entry in self.entries:
+            res[entry.inpath] = snapshotdiff(self.manifest.entries.get(entry.inpath), snapshots[entry.inpath])
+        return res
+
+    def findorphans(self):
+        # Outputs from the last build which no page produces now.
+        outpaths = set([ page.outpath for page in self.pages ])
+        self.orphans = [ outpath for outpath in self.manifest.outputs if outpath not in outpaths ]
+        self.orphans.sort()
+
+    def prune(self):
+        if not self.orphans:
+            return
+        print('Removing %d orphaned pages...' % (len(self.orphans),))
+        for outpath in self.orphans:
+            if len(self.orphans) < 20 or self.opts.longlist:
+                print('  .../'+outpath)
+            path = os.path.join(self.destdir, outpath)
+            if os.path.exists(path):
+                os.remove(path)
+            removesiblings(path)
+
+    def makemanifest(self):
+        """Create a manifest describing the current state of the site.
+        """
+        man = Manifest(os.path.join(self.destdir, MANIFEST_NAME))
+        man.fingerprint = buildfingerprint(self)
+        man.sources = self.getsourcerecords()
+        man.entries = self.getsnapshots()
+        for page in self.pages:
+            rec = {
+                'deps': pagedeps(page),
+                'layout': page.layout(),
+            }
+            rec.update(self.outputrecord(page))
+            man.outputs[page.outpath] = rec
+        return man
+
+    def outputrecord(self, page):
+        """The hash, mtime, and size of a page's output file. If the page
+        wasn't hashed this time, the last manifest's hash is reused, but
+        only if the file's mtime and size still match. (A build of named
+        pages rewrites files without updating the manifest.)
+        """
+        path = os.path.join(self.destdir, page.outpath)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return { 'hash': None, 'mtime': None, 'size': None }
+        hash = page.outhash
+        if hash is None and self.manifest is not None:
+            old = self.manifest.outputs.get(page.outpath)
+            if old and old.get('mtime') == stat.st_mtime and old.get('size') == stat.st_size:
+                hash = old.get('hash')
+        if hash is None:
+            hash = filehash(path)
+        return { 'hash': hash, 'mtime': stat.st_mtime, 'size': stat.st_size }
+
+    def outputhash(self, page):
+        # The hash of the page's output as of the last manifest. This
+        # may be out of date, so it's only used to skip recompression
+        # when a fresh hash matches it.
+        if self.manifest is not None:
+            old = self.manifest.outputs.get(page.outpath)
+            if old:
+                return old.get('hash')
+        return None
+
+    def writemanifest(self):
+        man = self.makemanifest()
+        man.save()
+        self.manifest = man
+
     def build(self, pagelist):
         print('Building %s...' % (xofypages(len(pagelist), len(self.pages)),))
+        bloggor.jextension.clearfragments(self.jenv)
         if len(pagelist) < 20 or self.opts.longlist:
             for page in pagelist:
                 print('  .../'+page.outpath)
                 
+        for page in self.pages:
+            # Left over from an earlier build, in --watch mode.
+            page.outhash = None
         for page in pagelist:
-            page.build()
+            page.prepare()
+
+        if self.opts.jobs > 1 and len(pagelist) > 1 and canfork():
+            self.buildparallel(pagelist)
+        else:
+            for page in pagelist:
+                page.build()
 
         ls = [ page.outpath for page in pagelist ]
         assert len(ls) == len(set(ls))
 
+        writtenls = [ page for page in pagelist if page.written ]
+        print('%d written, %d unchanged' % (len(writtenls), len(pagelist)-len(writtenls),))
+        self.reportsizes(pagelist)
+
         if self.opts.notemp:
             pass
         elif self.opts.nocommit:
             print('Skipping commit')   
-        else:
-            ls = [ page.tempoutpath for page in pagelist ]
+        elif writtenls:
+            ls = [ page.tempoutpath for page in writtenls ]
             assert len(ls) == len(set(ls))
             
-            print('Committing %s...' % (xofypages(len(pagelist), len(self.pages)),))
-            for page in pagelist:
+            print('Committing %s...' % (xofypages(len(writtenls), len(self.pages)),))
+            for page in writtenls:
                 page.commit()
 
+        if not self.opts.nocommit:
+            self.finishoutputs(pagelist)
+
         for page in self.draftentries:
             print('Draft: %s%s' % (self.serverurl, page.outuri,))
+
+    def finishoutputs(self, pagelist):
+        """Hash the committed output files (for the manifest), and write
+        their compressed siblings. Pages whose output didn't change are
+        skipped if their siblings are newer than the file.
+        """
+        if not self.encodings and not self.writesmanifest:
+            return
+        jobls = []
+        for page in pagelist:
+            path = os.path.join(self.destdir, page.outpath)
+            oldhash = self.outputhash(page)
+            if not page.written and siblingsfresh(path, self.encodings):
+                # The manifest will hash it if need be; see outputrecord().
+                continue
+            jobls.append( (page, (path, self.encodings, oldhash)) )
+        if not jobls:
+            return
+
+        if self.encodings:
+            print('Compressing %s (%s)...' % (xofypages(len(jobls), len(self.pages)), ', '.join(self.encodings),))
+        jobs = self.opts.jobs
+        args = [ arg for page, arg in jobls ]
+        if jobs > 1 and len(jobls) > 1 and canfork():
+            with compresspool(jobs) as pool:
+                results = list(pool.map(compresstask, args, chunksize=chunksize(len(args), jobs)))
+        else:
+            results = [ compresstask(arg) for arg in args ]
+        for (page, arg), hash in zip(jobls, results):
+            page.outhash = hash
+
+    def reportsizes(self, pagelist):
+        total = sum([ page.outsize for page in pagelist ])
+        print('Output size: %s' % (sizestr(total),))
+        if len(pagelist) > 1:
+            ls = sorted(pagelist, key=lambda page:-page.outsize)
+            for page in ls[ : REPORT_LARGEST ]:
+                print('  %s .../%s' % (sizestr(page.outsize), page.outpath,))
+
+    def buildparallel(self, pagelist):
+        """Build pages in a pool of worker processes. This only writes
+        the temp files; the caller commits them once every worker has
+        succeeded.
+        """
+        jobs = self.opts.jobs
+        indexmap = { id(page): ix for ix, page in enumerate(self.pages) }
+        ixls = [ indexmap[id(page)] for page in pagelist ]
+        chunks = partition(ixls, jobs*4)
+        
+        failures = []
+        with buildpool(jobs, self) as pool:
+            for res, results in pool.map(buildtask, chunks):
+                if res:
+                    failures.append(res)
+                for ix, written, outsize in results:
+                    self.pages[ix].written = written
+                    self.pages[ix].outsize = outsize
+
+        if failures:
+            for val in failures:
+                print(val)
+            raise RuntimeException('build failed in %d worker tasks; nothing committed' % (len(failures),))
@@ -0,0 +1,73 @@
+from bloggor.constants import Depend
+
+# The individual Depend bits, which the graph is indexed by.
+single_depends = [ Depend.CREATED, Depend.TITLE, Depend.BODY, Depend.TAGS, Depend.PUBDATE, Depend.UPDATE, Depend.COMMENTS ]
+
+# Changes which can add or remove an entry from a paginated series, or
+# move it between chunks. Since chunks are counted from the oldest entry,
+# these shift the entries of every newer chunk, and can change the links
+# of the chunk just before.
+series_depends = Depend.CREATED|Depend.TAGS|Depend.PUBDATE
+
+class DependGraph:
+    """An index of which pages depend on which entries, for working out
+    what to rebuild when an entry changes.
+
+    Most pages depend on a handful of entries, listed in their
+    backdependpages. Pages which depend on every live entry (the history
+    and tag list pages) set hubdepend instead. These hub pages are
+    stored once, rather than as an edge from every entry.
+    """
+    def __init__(self, pages, liveentries):
+        # { (entry, bit): [ page ] }
+        self.edges = {}
+        # { bit: [ page ] }
+        self.hubs = {}
+        self.liveset = set(liveentries)
+
+        for page in pages:
+            self.add(page)
+
+    def add(self, page):
+        if page.hubdepend:
+            for bit in dependbits(page.hubdepend):
+                if bit not in self.hubs:
+                    self.hubs[bit] = []
+                self.hubs[bit].append(page)
+        if page.backdependpages:
+            for entry, dep in page.backdependpages:
+                for bit in dependbits(dep):
+                    key = (entry, bit)
+                    if key not in self.edges:
+                        self.edges[key] = []
+                    self.edges[key].append(page)
+
+    def dependents(self, entry, dep):
+        """Return a PageSet of the pages which must be rebuilt if the
+        given fields of entry change. (Not including entry itself.)
+        """
+        pageset = PageSet()
+        islive = (entry in self.liveset)
+        for bit in dependbits(dep):
+            ls = self.edges.get( (entry, bit) )
+            if ls:
+                for page in ls:
+                    pageset.add(page)
+            if islive:
+                ls = self.hubs.get(bit)
+                if ls:
+                    for page in ls:
+                        pageset.add(page)
+        if dep & series_depends:
+            for page in list(pageset):
+                if page.chunkseries:
+                    ix = page.chunkseries.index(page)
+                    for page2 in page.chunkseries[ max(ix-1, 0) : ]:
+                        pageset.add(page2)
+        return pageset
+
+def dependbits(dep):
+    return [ bit for bit in single_depends if dep & bit ]
+
+
+from bloggor.pages import PageSet
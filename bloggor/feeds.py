@@ -0,0 +1,127 @@
+import io
+import html
+import json
+import feedgenerator
+
+from bloggor.constants import FeedType
+
+class PreparedItemsMixin:
+    """A feedgenerator feed whose items have already been serialized.
+
+    Each entry's feed item is written out once (per format) by
+    serializeitem(), and the text is pasted into every feed which
+    includes that entry. The item data is still added to the feed in
+    the usual way, because the feed header uses the item dates.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = []
+
+    @classmethod
+    def serializeitem(cla, args):
+        # Write the item with the plain feedgenerator code, so that it
+        # comes out exactly as it would in an ordinary feed.
+        feed = cla(title='', link='', description='')
+        feed.add_item(**args)
+        fl = io.StringIO()
+        handler = feedgenerator.SimplerXMLGenerator(fl, 'utf-8', short_empty_elements=True)
+        super(PreparedItemsMixin, feed).write_items(handler)
+        return fl.getvalue()
+
+    def add_prepared(self, text, **kwargs):
+        self.add_item(**kwargs)
+        self.prepared.append(text)
+
+    def write_items(self, handler):
+        for text in self.prepared:
+            # This writes the text unescaped.
+            handler.ignorableWhitespace(text)
+
+    def stream(self):
+        # feedgenerator builds the whole document in memory anyway.
+        return [ self.writeString('utf-8') ]
+
+class PreparedAtom1Feed(PreparedItemsMixin, feedgenerator.Atom1Feed):
+    pass
+
+class PreparedRss201rev2Feed(PreparedItemsMixin, feedgenerator.Rss201rev2Feed):
+    pass
+
+class JSONFeed:
+    """A JSON Feed (version 1.1) document. This takes the same arguments
+    as the feedgenerator classes, and the same prepared items.
+
+    The document is generated a piece at a time by stream(). Items are
+    written one per line.
+    """
+    def __init__(self, title, link, description, feed_url=None, author_name=None, language=None, categories=None):
+        # JSON Feed has no feed-level categories, so those are dropped.
+        self.feed = {
+            'version': 'https://jsonfeed.org/version/1.1',
+            'title': title,
+            'home_page_url': link,
+        }
+        if feed_url is not None:
+            self.feed['feed_url'] = feed_url
+        if description:
+            self.feed['description'] = description
+        if author_name is not None:
+            self.feed['authors'] = [ { 'name': author_name } ]
+        if language is not None:
+            self.feed['language'] = language
+        self.prepared = []
+
+    @classmethod
+    def serializeitem(cla, args):
+        item = {
+            'id': args['link'],
+            'url': args['link'],
+            'title': args['title'],
+            'content_html': args['content'],
+        }
+        if args.get('description'):
+            item['summary'] = html.unescape(args['description']).strip()
+        if args.get('pubdate') is not None:
+            item['date_published'] = feedgenerator.rfc3339_date(args['pubdate'])
+        if args.get('updateddate') is not None:
+            item['date_modified'] = feedgenerator.rfc3339_date(args['updateddate'])
+        if args.get('author_name') is not None:
+            item['authors'] = [ { 'name': args['author_name'] } ]
+        if args.get('categories'):
+            item['tags'] = list(args['categories'])
+        return json.dumps(item)
+
+    def add_prepared(self, text, **kwargs):
+        self.prepared.append(text)
+
+    def stream(self):
+        yield '{\n'
+        for key, val in self.feed.items():
+            yield '  %s: %s,\n' % (json.dumps(key), json.dumps(val),)
+        yield '  "items": ['
+        for ix, text in enumerate(self.prepared):
+            yield ('\n    ' if ix == 0 else ',\n    ')
+            yield text
+        yield '\n  ]\n}\n'
+
+feed_classes = {
+    FeedType.ATOM: PreparedAtom1Feed,
+    FeedType.RSS: PreparedRss201rev2Feed,
+    FeedType.JSON: JSONFeed,
+}
+
+def feedclass(format):
+    """Return the feed class for a FeedType.
+    """
+    if format not in feed_classes:
+        raise RuntimeException('unknown feed format: '+str(format))
+    return feed_classes[format]
+
+def serializeitem(format, args):
+    """Serialize one feed item (given as add_item() arguments) in the
+    given format.
+    """
+    return feedclass(format).serializeitem(args)
+
+
+from bloggor.excepts import RuntimeException
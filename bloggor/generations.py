@@ -0,0 +1,91 @@
+import os
+import os.path
+import shutil
+
+# Generations of the site live in a sibling of the destination directory,
+# named with this suffix.
+GENERATIONS_SUFFIX = '.gens'
+
+# How many generations to keep, counting the live one. The previous one
+# sticks around so that requests which started before the swap can finish.
+KEEP_GENERATIONS = 2
+
+class Generations:
+    """Publishes the destination directory atomically.
+
+    The destination is a symlink to one of a series of numbered
+    generation directories. A build writes into a new generation, which
+    starts out as a hardlinked copy of the live one. Publishing swaps
+    the symlink, which is a single rename.
+
+    Nothing may write into a file in place, because the files are
+    shared with the previous generation. (Writing a temp file and
+    renaming it is fine.)
+    """
+    def __init__(self, destdir):
+        self.destdir = os.path.normpath(destdir)
+        self.gensdir = self.destdir + GENERATIONS_SUFFIX
+        self.staging = None
+
+    def numbers(self):
+        if not os.path.isdir(self.gensdir):
+            return []
+        ls = [ int(val) for val in os.listdir(self.gensdir) if val.isdigit() ]
+        ls.sort()
+        return ls
+
+    def begin(self):
+        """Create the staging directory for a new generation, and return
+        its path.
+        """
+        os.makedirs(self.gensdir, exist_ok=True)
+        ls = self.numbers()
+        num = (ls[-1] if ls else 0) + 1
+
+        current = None
+        if os.path.islink(self.destdir):
+            current = os.path.realpath(self.destdir)
+        elif os.path.isdir(self.destdir):
+            # The first atomic build. The existing directory becomes
+            # the first generation.
+            current = os.path.join(self.gensdir, str(num))
+            print('Moving %s to %s...' % (self.destdir, current,))
+            os.rename(self.destdir, current)
+            self.swap(current)
+            num += 1
+
+        self.staging = os.path.join(self.gensdir, str(num))
+        if current:
+            linktree(current, self.staging)
+        else:
+            os.makedirs(self.staging)
+        return self.staging
+
+    def swap(self, target):
+        target = os.path.relpath(target, start=os.path.dirname(os.path.abspath(self.destdir)))
+        temppath = self.destdir + '_tmp'
+        if os.path.lexists(temppath):
+            os.remove(temppath)
+        os.symlink(target, temppath)
+        os.replace(temppath, self.destdir)
+
+    def publish(self):
+        print('Publishing %s...' % (self.staging,))
+        self.swap(self.staging)
+        self.staging = None
+        self.cleanup()
+
+    def abort(self):
+        if self.staging:
+            shutil.rmtree(self.staging, ignore_errors=True)
+            self.staging = None
+
+    def cleanup(self):
+        ls = self.numbers()
+        for num in ls[ : -KEEP_GENERATIONS ]:
+            shutil.rmtree(os.path.join(self.gensdir, str(num)))
+
+def linktree(src, dest):
+    """Copy a directory tree, hardlinking the files.
+    """
+    shutil.copytree(src, dest, symlinks=True, copy_function=os.link)
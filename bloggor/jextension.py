@@ -1,4 +1,5 @@
 
+from jinja2 import nodes
 from jinja2.ext import Extension
 
 class TagFilename(Extension):
@@ -13,4 +14,53 @@ class CommentDepthStep(Extension):
     def __init__(self, env):
         env.filters['depthstep'] = depthstep
         
+class FragmentCache(Extension):
+    """Adds a {% cache key, ... %}...{% endcache %} tag. The block is
+    rendered once for each distinct key, and then reused. The key
+    should include every template variable which the block uses.
+
+    The cache belongs to the Environment. Call clearfragments() when
+    the data may have changed (i.e., at the start of a build).
+    """
+    tags = set(['cache'])
+    
+    def __init__(self, env):
+        Extension.__init__(self, env)
+        env.extend(fragment_cache={})
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [ parser.parse_expression() ]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        call = self.call_method('_cache', [ nodes.List(args) ])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _cache(self, args, caller):
+        cache = self.environment.fragment_cache
+        key = fragmentkey(args)
+        res = cache.get(key)
+        if res is None:
+            res = caller()
+            cache[key] = res
+        return res
+
+def fragmentkey(val):
+    """Turn a cache key into something hashable. Lists and dicts are
+    converted to tuples; other unhashable values to their repr.
+    """
+    if isinstance(val, (list, tuple)):
+        return tuple([ fragmentkey(subval) for subval in val ])
+    if isinstance(val, dict):
+        return tuple([ (key, fragmentkey(subval)) for key, subval in sorted(val.items()) ])
+    try:
+        hash(val)
+        return val
+    except TypeError:
+        return repr(val)
+
+def clearfragments(env):
+    env.fragment_cache.clear()
+        
 from bloggor.util import tagfilename, splitatmore, depthstep
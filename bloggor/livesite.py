@@ -0,0 +1,106 @@
+import time
+import threading
+import collections
+import urllib.parse
+
+# How many rendered pages to keep in memory.
+CACHE_SIZE = 256
+
+# Don't check the source directories more often than this, in seconds.
+REFRESH_INTERVAL = 0.5
+
+class LiveSite:
+    """Renders pages on request from a resident Context, rather than
+    serving files out of the destination directory.
+
+    Rendered pages are kept in an LRU cache, keyed by outpath. When a
+    source file changes, it is re-read, and the cached pages which
+    depend on it (as worked out by autopages(), against the in-memory
+    manifest) are dropped.
+    """
+    def __init__(self, ctx, cachesize=CACHE_SIZE):
+        self.ctx = ctx
+        self.cachesize = cachesize
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.lastrefresh = time.time()
+
+        ctx.errors = []
+        ctx.readsrc()
+        if ctx.errors:
+            raise RuntimeException('%d errors reading source' % (len(ctx.errors),))
+        ctx.addnonsrc()
+        # The manifest on disk (if any) just saves hashing unchanged
+        # source files. From here on we keep our own, in memory.
+        ctx.loadmanifest()
+        ctx.manifest = ctx.makemanifest()
+        self.watcher = Watcher(ctx)
+        self.index()
+
+    def index(self):
+        self.pagesbyoutpath = {}
+        for page in self.ctx.pages:
+            self.pagesbyoutpath[page.outpath] = page
+
+    def refresh(self):
+        """Check for changed source files. Called with the lock held.
+        """
+        now = time.time()
+        if now - self.lastrefresh < REFRESH_INTERVAL:
+            return
+        self.lastrefresh = now
+
+        ctx = self.ctx
+        if not self.watcher.refresh():
+            return
+        ctx.sourcerecords = None
+        ctx.orphans = []
+        pagelist = ctx.autopages(reload=False)
+        clearfragments(ctx.jenv)
+        ctx.manifest = ctx.makemanifest()
+        self.index()
+        for page in pagelist:
+            self.cache.pop(page.outpath, None)
+        for outpath in list(self.cache):
+            if outpath not in self.pagesbyoutpath:
+                del self.cache[outpath]
+
+    def findpage(self, urlpath):
+        """Map a request path to a page, or None.
+        """
+        path = urllib.parse.urlsplit(urlpath).path
+        path = urllib.parse.unquote(path).lstrip('/')
+        if path == '' or path.endswith('/'):
+            candidates = [ path+'index.html' ]
+        else:
+            candidates = [ path, path+'.html', path+'.xml' ]
+        for outpath in candidates:
+            page = self.pagesbyoutpath.get(outpath)
+            if page is not None:
+                return page
+        return None
+
+    def get(self, urlpath):
+        """Return (outpath, bytes) for the page at the given request
+        path, rendering it if necessary. Returns None if no page matches;
+        the caller should fall back to the destination directory.
+        """
+        with self.lock:
+            self.refresh()
+            page = self.findpage(urlpath)
+            if page is None:
+                return None
+            data = self.cache.get(page.outpath)
+            if data is not None:
+                self.cache.move_to_end(page.outpath)
+                return (page.outpath, data)
+            data = page.render().encode('utf-8')
+            self.cache[page.outpath] = data
+            while len(self.cache) > self.cachesize:
+                self.cache.popitem(last=False)
+            return (page.outpath, data)
+
+
+from bloggor.excepts import RuntimeException
+from bloggor.watch import Watcher
+from bloggor.jextension import clearfragments
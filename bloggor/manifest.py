@@ -0,0 +1,205 @@
+import os
+import os.path
+import json
+import hashlib
+
+# Bump this if the format of the manifest changes.
+MANIFEST_VERSION = 8
+
+MANIFEST_NAME = '.bloggor-manifest.json'
+
+# The deps key for pages which depend on every live entry.
+HUB_KEY = '*'
+
+class Manifest:
+    """A record of what the last full (or automatic) build produced.
+    This is written into the destination directory after a successful
+    commit, and read back on the next run to work out what has changed.
+
+    sources: { inpath: { mtime, size, hash } } for every source file
+    (entries, pages, comments).
+    entries: { inpath: snapshot } for every entry; see entrysnapshot().
+    outputs: { outpath: { deps: { inpath: mask }, layout, hash, mtime,
+    size } } for every page built. The deps are the entries which the
+    page depends on, with the Depend mask. A page which depends on every
+    live entry has the single key HUB_KEY instead. The layout is
+    Page.layout(), for pages which are split into chunks. The hash is
+    the SHA-1 of the output file; mtime and size are its stat as of
+    when the manifest was written, so that a hash can be trusted only
+    if the file hasn't changed since.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fingerprint = None
+        self.sources = {}
+        self.entries = {}
+        self.outputs = {}
+        self.reversedeps = None
+        self.hubdeps = None
+
+    def load(self):
+        """Read the manifest file. Returns False if there isn't one
+        (or it's unusable).
+        """
+        try:
+            fl = open(self.path)
+        except FileNotFoundError:
+            return False
+        try:
+            dat = json.load(fl)
+        except ValueError:
+            print('Manifest file is corrupt; ignoring it')
+            return False
+        finally:
+            fl.close()
+        if dat.get('version') != MANIFEST_VERSION:
+            return False
+        self.fingerprint = dat['fingerprint']
+        self.sources = dat['sources']
+        self.entries = dat['entries']
+        self.outputs = dat['outputs']
+        return True
+
+    def save(self):
+        dat = {
+            'version': MANIFEST_VERSION,
+            'fingerprint': self.fingerprint,
+            'sources': self.sources,
+            'entries': self.entries,
+            'outputs': self.outputs,
+        }
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temppath = self.path + '_tmp'
+        fl = open(temppath, 'w')
+        json.dump(dat, fl, indent=1, sort_keys=True)
+        fl.close()
+        os.replace(temppath, self.path)
+
+    def sourcerecord(self, inpath, path, stat):
+        """Return a record of a source file, given its stat. The hash is
+        only recomputed if the mtime or size differ from our record.
+        """
+        rec = self.sources.get(inpath)
+        if rec and rec['mtime'] == stat.st_mtime and rec['size'] == stat.st_size:
+            return rec
+        return {
+            'mtime': stat.st_mtime,
+            'size': stat.st_size,
+            'hash': filehash(path),
+        }
+
+    def outputdeps(self, inpath):
+        """Return a list of (outpath, mask) for outputs which depended
+        on the given entry, as of the last build.
+        """
+        if self.reversedeps is None:
+            self.reversedeps = {}
+            self.hubdeps = []
+            for outpath, rec in self.outputs.items():
+                for key, mask in rec['deps'].items():
+                    if key == HUB_KEY:
+                        self.hubdeps.append( (outpath, Depend(mask)) )
+                        continue
+                    if key not in self.reversedeps:
+                        self.reversedeps[key] = []
+                    self.reversedeps[key].append( (outpath, Depend(mask)) )
+        res = self.reversedeps.get(inpath, [])
+        snapshot = self.entries.get(inpath)
+        if snapshot and snapshot['live']:
+            res = res + self.hubdeps
+        return res
+
+
+def entrysnapshot(entry, sourcehash, commenthash=None):
+    """The fields of an entry which other pages care about. The body,
+    the remaining metadata, and the comments file are represented by
+    hashes. The body is represented by the hash of the whole source
+    file, so that we don't have to convert it.
+    """
+    meta = { key: val for key, val in entry.metadata.items() if key not in snapshot_metakeys }
+    return {
+        'outuri': entry.outuri,
+        'live': entry.live,
+        'title': entry.title,
+        'tags': entry.tags,
+        'published': entry.publishedraw,
+        'updated': entry.updatedraw,
+        'body': sourcehash,
+        'meta': stringhash(json.dumps(meta, sort_keys=True)),
+        'comments': commenthash,
+    }
+
+# Metadata keys which entrysnapshot() records as separate fields.
+snapshot_metakeys = set([ 'title', 'tags', 'published', 'updated', 'live' ])
+
+def snapshotdiff(old, new):
+    """Compare two entry snapshots, and return the Depend mask of the
+    fields that changed. Either may be None, meaning the entry didn't
+    exist.
+    """
+    if old is None and new is None:
+        return Depend.NONE
+    if old is None or new is None:
+        return Depend.ALL
+    if old['live'] != new['live'] or old['outuri'] != new['outuri']:
+        return Depend.ALL
+    if not new['live']:
+        # Drafts don't appear on any other page.
+        return Depend.NONE
+    
+    res = Depend.NONE
+    if old['title'] != new['title']:
+        res |= Depend.TITLE
+    if old['tags'] != new['tags']:
+        res |= Depend.TAGS
+    if old['published'] != new['published']:
+        res |= Depend.PUBDATE
+    if old['updated'] != new['updated']:
+        res |= Depend.UPDATE
+    if old['body'] != new['body'] or old['meta'] != new['meta']:
+        res |= Depend.BODY
+    if old['comments'] != new['comments']:
+        res |= Depend.COMMENTS
+    return res
+
+def pagedeps(page):
+    """The entries which a page depends on, as { inpath: mask }.
+    """
+    res = {}
+    if page.hubdepend:
+        res[HUB_KEY] = int(page.hubdepend)
+    if page.backdependpages:
+        for entry, dep in page.backdependpages:
+            res[entry.inpath] = res.get(entry.inpath, 0) | int(dep)
+    return res
+
+def stringhash(val):
+    return hashlib.sha1(val.encode()).hexdigest()
+
+def buildfingerprint(ctx):
+    """Generate a string which changes whenever every page must be
+    rebuilt: the templates, the config, or the generator itself.
+    """
+    hasher = hashlib.sha1()
+    hasher.update(cachefingerprint(ctx).encode())
+    ls = []
+    tempdir = os.path.join(ctx.opts.srcdir, 'templates')
+    for dirpath, dirnames, filenames in os.walk(tempdir):
+        for filename in filenames:
+            if filename.startswith('.') or filename.endswith('~'):
+                continue
+            path = os.path.join(dirpath, filename)
+            ls.append( (os.path.relpath(path, start=tempdir), path) )
+    moddir = os.path.dirname(__file__)
+    for filename in os.listdir(moddir):
+        if filename.endswith('.py'):
+            ls.append( ('bloggor/'+filename, os.path.join(moddir, filename)) )
+    ls.sort()
+    for label, path in ls:
+        hasher.update(label.encode())
+        hasher.update(filehash(path).encode())
+    return hasher.hexdigest()
+
+
+from bloggor.constants import Depend
+from bloggor.cache import filehash, cachefingerprint
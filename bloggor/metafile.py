@@ -25,18 +25,49 @@ class MetaFile:
         if self.content is not None:
             return self.content, self.meta
         
-        self.meta = {}
-        self.content = ''
+        if self.stream:
+            fl = self.stream
+        else:
+            fl = open(self.filename)
+
+        self.readheader(fl)
+        self.content = self.leftover + fl.read()
 
+        if fl != self.stream:
+            fl.close()
+
+        return self.content, self.meta
+
+    def readmeta(self):
+        """Read only the metadata header, and stop there. The content
+        is not read.
+        """
+        if self.meta is not None:
+            return self.meta
+        
         if self.stream:
             fl = self.stream
         else:
             fl = open(self.filename)
+
+        self.readheader(fl)
+
+        if fl != self.stream:
+            fl.close()
+
+        return self.meta
+
+    def readheader(self, fl):
+        self.meta = {}
+        # The first line of content, if we read it while looking for
+        # the end of the header.
+        self.leftover = ''
         
         ln = fl.readline()
         if not BEGIN_RE.match(ln):
-            self.content = ln
+            self.leftover = ln
         else:
+            key = None
             while True:
                 ln = fl.readline()
                 if ln.strip() == '' or END_RE.match(ln):
@@ -56,14 +87,54 @@ class MetaFile:
                         # Add another line to existing key
                         self.meta[key].append(m2.group('value').strip())
                     else:
-                        self.content = ln
+                        self.leftover = ln
                         break  # no meta data - done
-        self.content += fl.read()
 
-        if fl != self.stream:
+def readmdmeta(filename=None, stream=None):
+    """Read the metadata header of a Markdown file, the same way the
+    Markdown "meta" extension would, without converting the rest.
+    (The header may or may not start with a "---" line.)
+    """
+    meta = {}
+    key = None
+    if stream:
+        fl = stream
+    else:
+        fl = open(filename)
+    try:
+        ln = fl.readline()
+        if ln and BEGIN_RE.match(mdnormalize(ln)):
+            ln = fl.readline()
+        while ln:
+            ln = mdnormalize(ln)
+            if ln.strip() == '' or END_RE.match(ln):
+                # blank line or end of YAML header - done
+                break
+            m1 = META_RE.match(ln)
+            if m1:
+                key = m1.group('key').lower().strip()
+                value = m1.group('value').strip()
+                try:
+                    meta[key].append(value)
+                except KeyError:
+                    meta[key] = [value]
+            else:
+                m2 = META_MORE_RE.match(ln)
+                if m2 and key:
+                    # Add another line to existing key
+                    meta[key].append(m2.group('value').strip())
+                else:
+                    break  # no meta data - done
+            ln = fl.readline()
+    finally:
+        if fl != stream:
             fl.close()
+    return meta
 
-        return self.content, self.meta
+def mdnormalize(ln):
+    # As Markdown's NormalizeWhitespace preprocessor does, before the
+    # meta extension sees the line.
+    return ln.rstrip('\r\n').expandtabs(4)
 
 pat_dashes = re.compile(r'^(---+)\s*$')
 
@@ -1,9 +1,15 @@
 import os.path
+import bisect
 import datetime
-import feedgenerator
 import markupsafe
 from fnmatch import fnmatch
 
+# Output files are written through a buffer of this size.
+WRITE_BUFFER = 65536
+
+# How many entries go in a feed.
+FEED_LENGTH = 25
+
 class PageSet:
     def __init__(self):
         self.ls = []
@@ -21,6 +27,87 @@ class PageSet:
             self.ls.append(page)
 
 
+class PageIndex:
+    """Finds the pages which match page specs (as given on the command
+    line). A spec matches a page's outpath or outuri exactly, or the end
+    of its inpath if the spec contains a dot. A spec containing "*" is
+    a wildcard, matched against outuris.
+    """
+    def __init__(self, pages):
+        self.pages = pages
+        self.order = {}
+        self.byoutpath = {}
+        self.byouturi = {}
+        # (reversed inpath, page), sorted, for suffix lookups.
+        self.revinpaths = []
+        # (outuri, page), sorted, for wildcard lookups.
+        self.outuris = []
+
+        for ix, page in enumerate(pages):
+            self.order[id(page)] = ix
+            self.byoutpath[page.outpath] = page
+            if page.outuri not in self.byouturi:
+                self.byouturi[page.outuri] = []
+            self.byouturi[page.outuri].append(page)
+            if page.inpath is not None:
+                self.revinpaths.append( (page.inpath[::-1], ix) )
+            self.outuris.append( (page.outuri, ix) )
+        self.revinpaths.sort()
+        self.outuris.sort()
+
+    def match(self, spec):
+        """Return a list of the pages matching a single spec.
+        """
+        res = []
+        if '*' in spec:
+            pos = min([ spec.find(ch) for ch in '*?[' if ch in spec ])
+            for outuri, ix in prefixrange(self.outuris, spec[ : pos ]):
+                if fnmatch(outuri, spec):
+                    res.append(self.pages[ix])
+            return res
+        
+        page = self.byoutpath.get(spec)
+        if page is not None:
+            res.append(page)
+        res.extend(self.byouturi.get(spec, []))
+        if '.' in spec:
+            for revinpath, ix in prefixrange(self.revinpaths, spec[::-1]):
+                res.append(self.pages[ix])
+        return res
+
+    def matchspecs(self, specs, recentlimit=None):
+        """Return a list of (page, dep) for the pages matching any of the
+        specs (a list of (spec, dep) pairs), in page order. If recentlimit
+        is given, pages whose source changed since then match as well.
+        """
+        deps = {}
+        for (spec, dep) in specs:
+            for page in self.match(spec):
+                key = id(page)
+                deps[key] = deps.get(key, Depend.NONE) | dep
+
+        if recentlimit is not None:
+            for page in self.pages:
+                if page.inmodtime is not None and page.inmodtime >= recentlimit:
+                    # Combined with whatever the specs asked for.
+                    key = id(page)
+                    dep = page.changedep if page.changedep is not None else Depend.ALL
+                    deps[key] = deps.get(key, Depend.NONE) | dep
+
+        ls = list(deps.keys())
+        ls.sort(key=lambda key:self.order[key])
+        return [ (self.pages[self.order[key]], deps[key]) for key in ls ]
+
+def prefixrange(ls, prefix):
+    """Given a sorted list of (key, val) pairs, yield the ones whose key
+    starts with prefix.
+    """
+    pos = bisect.bisect_left(ls, (prefix,))
+    while pos < len(ls) and ls[pos][0].startswith(prefix):
+        yield ls[pos]
+        pos += 1
+
+        
 class Page:
     def __init__(self, ctx):
         self.ctx = ctx
@@ -38,12 +125,81 @@ class Page:
         self.outdir = None
         self.frequent = False
 
+        # List of (entry, dep) for the entries this page displays.
         self.backdependpages = None
-        self.dependpages = None
+        # If set, this page depends on every live entry, with this mask.
+        self.hubdepend = None
+
+        # If set, the fields which changed since the last build.
+        self.changedep = None
+
+        # Set by build(): False if the output was identical to the
+        # existing file, so nothing was written.
+        self.written = None
+        # Also set by build(): the size of the output, in bytes.
+        self.outsize = None
+        # Set by finishoutputs(): the SHA-1 hash of the output file.
+        self.outhash = None
+
+        # For a page which is one of a paginated series; see setchunk().
+        self.baseoutpath = None
+        self.chunknum = None
+        self.chunkcount = None
+        # All the pages of the series, including this one.
+        self.chunkseries = None
+
+    def setchunk(self, baseoutpath, chunk):
+        """Set the outpath of a page which may be split into several.
+        If chunk is None, the page isn't split. Otherwise chunk is
+        (num, count, main): chunk num (counting from 1, oldest first)
+        of count. The main page (at baseoutpath) repeats the newest
+        chunk.
+        """
+        if chunk is None:
+            self.outpath = baseoutpath
+            return
+        num, count, main = chunk
+        self.baseoutpath = baseoutpath
+        self.chunknum = num
+        self.chunkcount = count
+        if main:
+            self.outpath = baseoutpath
+        else:
+            self.outpath = chunkoutpath(baseoutpath, num)
+
+    def chunklinks(self):
+        """Return a dict of template arguments for linking to the
+        neighboring chunks. (Empty if the page isn't split.)
+        """
+        if self.chunknum is None:
+            return {}
+        # Not the chunk count: that would change every chunk whenever
+        # a new one is started.
+        res = {
+            'chunknum': self.chunknum,
+            'neweruri': None,
+            'olderuri': None,
+        }
+        if self.chunknum < self.chunkcount:
+            res['neweruri'] = linkuri(chunkoutpath(self.baseoutpath, self.chunknum+1))
+        if self.chunknum > 1:
+            res['olderuri'] = linkuri(chunkoutpath(self.baseoutpath, self.chunknum-1))
+        return res
+
+    def layout(self):
+        """Return what the page shows about its series, beyond its own
+        entries: its links to the older and newer chunks. The manifest
+        records this, so that when a chunk is added or removed, its
+        neighbor is rebuilt. (None if the page isn't split.)
+        """
+        if self.chunknum is None:
+            return None
+        links = self.chunklinks()
+        return [ links['olderuri'], links['neweruri'] ]
 
     def complete(self):
         self.outuri, dot, suffix = self.outpath.rpartition('.')
-        if suffix not in ('html', 'rss', 'xml'):
+        if suffix not in ('html', 'rss', 'xml', 'json'):
             raise RuntimeException(self.outpath+': not html or other known suffix')
         if '.' in self.outuri:
             raise RuntimeException(self.outuri+': uri contains dot')
@@ -61,54 +217,131 @@ class Page:
     def __repr__(self):
         return '<%s "%s">' % (self.__class__.__name__, self.outuri)
 
-    def matchspecs(self, specs, recentlimit=None):
-        res = None
-
-        if recentlimit is not None and self.inmodtime is not None:
-            if self.inmodtime >= recentlimit:
-                return Depend.ALL
-        
-        for (spec, dep) in specs:
-            if self.match(spec):
-                if res is None:
-                    res = dep
-                else:
-                    res |= dep
-                if res == Depend.ALL:
-                    return Depend.ALL
-
-        return res
-
-    def match(self, spec):
-        if '*' in spec:
-            if fnmatch(self.outuri, spec):
-                return True
-        else:
-            if self.outpath == spec:
-                return True
-            if self.outuri == spec:
-                return True
-            if '.' in spec:
-                if self.inpath is not None and self.inpath.endswith(spec):
-                    return True
-        return False
-
     def openwrite(self):
         if self.outdir:
-            os.makedirs(os.path.join(self.opts.destdir, self.outdir), exist_ok=True)
+            os.makedirs(os.path.join(self.ctx.destdir, self.outdir), exist_ok=True)
             
-        fl = open(os.path.join(self.opts.destdir, self.tempoutpath), 'w')
+        fl = open(os.path.join(self.ctx.destdir, self.tempoutpath), 'w', buffering=WRITE_BUFFER)
         return fl
 
     def commit(self):
         assert self.tempoutpath != self.outpath
-        os.replace(os.path.join(self.opts.destdir, self.tempoutpath), os.path.join(self.opts.destdir, self.outpath))
+        os.replace(os.path.join(self.ctx.destdir, self.tempoutpath), os.path.join(self.ctx.destdir, self.outpath))
 
     def read(self):
         raise Exception(repr(self)+': read() not implemented')
 
+    def hassource(self, stat):
+        """Check whether loadsource() can return the converted source
+        without doing the conversion now.
+        """
+        if self.path in self.ctx.prefetched:
+            return True
+        cache = self.ctx.readcache
+        if cache is not None and cache.has(self.inpath, self.path, stat):
+            return True
+        return False
+
+    def loadsource(self, stat):
+        """Read and convert the source file, or fetch the results from
+        the read cache if the file hasn't changed. Returns a dict with
+        (at least) body and metadata.
+        """
+        cache = self.ctx.readcache
+        if cache is not None:
+            dat = cache.get(self.inpath, self.path, stat)
+            if dat is not None:
+                return dat
+
+        if self.path in self.ctx.prefetched:
+            res = self.ctx.prefetched.pop(self.path)
+            if isinstance(res, RuntimeException):
+                raise res
+            body, metadata = res
+        else:
+            body, metadata = readsourcefile(self.path, self.type, self.mdenv)
+        dat = { 'body': body, 'metadata': metadata }
+        self.derivesource(dat)
+
+        if cache is not None:
+            cache.put(self.inpath, self.path, stat, dat)
+        return dat
+
+    def derivesource(self, dat):
+        # Subclasses can add cacheable fields which are derived from
+        # the body.
+        pass
+
+    def prepare(self):
+        # Called in the main process before the page is built.
+        pass
+
+    def render(self):
+        return ''.join(self.stream())
+
+    def stream(self):
+        """Return an iterable of strings which make up the page's output.
+        Template pages return template.generate(), so that build() can
+        write the page out as it is rendered.
+        """
+        raise Exception(repr(self)+': stream() not implemented')
+
     def build(self):
-        raise Exception(repr(self)+': build() not implemented')
+        """Write the page's output to its temp file as it's generated.
+
+        The output is compared with the existing file along the way.
+        Nothing is written until the two differ; if they never do, the
+        existing file (and its mtime) is left alone.
+        """
+        oldfl = self.openexisting()
+        fl = None
+        matched = 0
+        try:
+            for text in self.stream():
+                if fl is None:
+                    if oldfl is not None and readsame(oldfl, text):
+                        matched += len(text)
+                        continue
+                    fl = self.startwrite(oldfl, matched)
+                    oldfl = None
+                fl.write(text)
+            if fl is None:
+                if oldfl is not None and readsame(oldfl, None):
+                    self.written = False
+                    self.outsize = os.fstat(oldfl.fileno()).st_size
+                    return
+                fl = self.startwrite(oldfl, matched)
+                oldfl = None
+            fl.close()
+            self.written = True
+            self.outsize = os.path.getsize(fl.name)
+        finally:
+            if oldfl is not None:
+                oldfl.close()
+            if fl is not None:
+                fl.close()
+
+    def openexisting(self):
+        try:
+            return open(os.path.join(self.ctx.destdir, self.outpath))
+        except FileNotFoundError:
+            return None
+
+    def startwrite(self, oldfl, matched):
+        """Open the temp file, once the output turns out to differ from
+        the existing file. The first matched characters were the same,
+        so they're copied over. (In --notemp mode the temp file is the
+        existing file, so they have to be read before it's opened.)
+        """
+        prefix = ''
+        if oldfl is not None:
+            if matched:
+                oldfl.seek(0)
+                prefix = oldfl.read(matched)
+            oldfl.close()
+        fl = self.openwrite()
+        fl.write(prefix)
+        return fl
 
 
 class GenTemplatePage(Page):
@@ -122,11 +355,9 @@ class GenTemplatePage(Page):
     def read(self):
         pass
         
-    def build(self):
-        fl = self.openwrite()
+    def stream(self):
         template = self.jenv.get_template(self.template)
-        fl.write(template.render())
-        fl.close()
+        return template.generate()
 
         
 class StaticPage(Page):
@@ -155,29 +386,12 @@ class StaticPage(Page):
         self.complete()
 
     def read(self):
-        stat = os.stat(self.path)
+        stat = self.ctx.statfile(self.path)
         self.inmodtime = stat.st_mtime
-        
-        if self.type == FileType.HTML:
-            mfl = MetaFile(self.path)
-            body, metadata = mfl.read()
-        elif self.type == FileType.TXT:
-            mfl = MetaFile(self.path)
-            body, metadata = mfl.read()
-            val = str(markupsafe.escape(body))
-            body = '<div class="PreWrapAll">\n%s</div>' % (val,)
-        elif self.type == FileType.MD:
-            fl = open(self.path)
-            dat = fl.read()
-            fl.close()
-            self.mdenv.reset()
-            body = self.mdenv.convert(dat)
-            metadata = self.mdenv.Meta
-        else:
-            raise RuntimeException(self.path+': Unrecognized entry format: ' + self.type)
 
-        self.body = body
-        self.metadata = metadata
+        dat = self.loadsource(stat)
+        self.body = dat['body']
+        self.metadata = dat['metadata']
 
         self.title = None
         ls = self.metadata.get('title', None)
@@ -187,13 +401,11 @@ class StaticPage(Page):
         if not self.title:
             raise RuntimeException(self.path+': No title')
 
-    def build(self):
-        fl = self.openwrite()
+    def stream(self):
         template = self.jenv.get_template('static.html')
-        fl.write(template.render(
+        return template.generate(
             title=self.title,
-            body=self.body))
-        fl.close()
+            body=self.body)
 
         
 class FrontPage(Page):
@@ -204,14 +416,12 @@ class FrontPage(Page):
         self.backdependpages = [ (page, Depend.ALL) for page in ctx.recententries ]
         self.complete()
 
-    def build(self):
-        fl = self.openwrite()
+    def stream(self):
         template = self.jenv.get_template('front.html')
-        fl.write(template.render(
+        return template.generate(
             title=None,
             entries=self.ctx.recententries,
-            recentfew=self.ctx.recentfew))
-        fl.close()
+            recentfew=self.ctx.recentfew)
 
 
 class RecentEntriesPage(Page):
@@ -233,67 +443,63 @@ class RecentEntriesPage(Page):
         self.backdependpages = [ (page, Depend.ALLBUTBODY) for page in entries ]
         self.complete()
 
-    def build(self):
+    def stream(self):
         entries = self.ctx.liveentries[ self.livepos : ]
         entries.reverse()
         
         yearls = list(self.ctx.entriesbyyear.keys())
         yearls.sort(reverse=True)
 
-        fl = self.openwrite()
         template = self.jenv.get_template('recent.html')
-        fl.write(template.render(
+        return template.generate(
             title='Recent Posts',
             entries=entries,
             years=yearls,
-            recentfew=self.ctx.recentfew))
-        fl.close()
+            recentfew=self.ctx.recentfew)
         
     
 class YearEntriesPage(Page):
-    def __init__(self, ctx, year, pagels):
+    def __init__(self, ctx, year, pagels, chunk=None):
         Page.__init__(self, ctx)
         self.year = year
-        self.outpath = '%d/index.html' % (self.year,)
+        self.pagels = pagels
+        self.setchunk('%d/index.html' % (self.year,), chunk)
         self.backdependpages = [ (page, Depend.ALLBUTBODY) for page in pagels ]
         self.complete()
 
-    def build(self):
-        entries = self.ctx.entriesbyyear[self.year]
-        entries.reverse()
+    def stream(self):
+        entries = list(reversed(self.pagels))
 
         yearls = list(self.ctx.entriesbyyear.keys())
         yearls.sort(reverse=True)
 
-        fl = self.openwrite()
         template = self.jenv.get_template('recent.html')
-        fl.write(template.render(
+        return template.generate(
             title='Posts From %d' % (self.year,),
             year=self.year,
             entries=entries,
-            years=yearls))
-        fl.close()
+            years=yearls,
+            **self.chunklinks())
         
     
 class MonthEntriesPage(Page):
-    def __init__(self, ctx, month, pagels):
+    def __init__(self, ctx, month, pagels, chunk=None):
         Page.__init__(self, ctx)
         self.month = month
+        self.pagels = pagels
         pathel = '/'.join(self.month.split('-'))
-        self.outpath = '%s/index.html' % (pathel,)
+        self.setchunk('%s/index.html' % (pathel,), chunk)
         self.backdependpages = [ (page, Depend.ALLBUTBODY) for page in pagels ]
         self.complete()
 
-    def build(self):
-        entries = self.ctx.entriesbymonth[self.month]
-        entries.reverse()
+    def stream(self):
+        entries = list(reversed(self.pagels))
 
-        fl = self.openwrite()
         template = self.jenv.get_template('recent.html')
-        fl.write(template.render(
+        return template.generate(
             title='Posts From %s' % (self.month,),
-            entries=entries))
-        fl.close()
+            entries=entries,
+            **self.chunklinks())
         
     
 class HistoryPage(Page):
@@ -301,10 +507,10 @@ class HistoryPage(Page):
         Page.__init__(self, ctx)
         self.outpath = 'history.html'
         self.frequent = True
-        self.backdependpages = [ (page, Depend.CREATED|Depend.PUBDATE) for page in ctx.liveentries ]
+        self.hubdepend = Depend.CREATED|Depend.PUBDATE
         self.complete()
 
-    def build(self):
+    def stream(self):
         yearls = list(self.ctx.entriesbyyear.keys())
         yearls = [ (key, len(ls)) for key, ls in self.ctx.entriesbyyear.items() ]
         yearls.sort()
@@ -316,14 +522,12 @@ class HistoryPage(Page):
             ('October', '10'), ('November', '11'), ('December', '12'),
         ]
 
-        fl = self.openwrite()
         template = self.jenv.get_template('history.html')
-        fl.write(template.render(
+        return template.generate(
             title='Blog Archive',
             years=yearls,
             months=monthls,
-            recentfew=self.ctx.recentfew))
-        fl.close()
+            recentfew=self.ctx.recentfew)
 
 
 class TagListPage(Page):
@@ -331,10 +535,10 @@ class TagListPage(Page):
         Page.__init__(self, ctx)
         self.outpath = 'tags.html'
         self.frequent = True
-        self.backdependpages = [ (page, Depend.TAGS|Depend.CREATED) for page in ctx.liveentries ]
+        self.hubdepend = Depend.TAGS|Depend.CREATED
         self.complete()
 
-    def build(self):
+    def stream(self):
         tags = [ (tag, sortform(tag), len(ls)) for tag, ls in self.ctx.entriesbytag.items() ]
         tags.sort(key=lambda tup:tup[1])
 
@@ -349,14 +553,12 @@ class TagListPage(Page):
                 groups.append(pair)
             pair[1].append(tup)
         
-        fl = self.openwrite()
         template = self.jenv.get_template('tags.html')
-        fl.write(template.render(
+        return template.generate(
             title='All Tags (Alphabetical)',
             taggroups=groups,
             sortby='alpha',
-            recentfew=self.ctx.recentfew))
-        fl.close()
+            recentfew=self.ctx.recentfew)
 
 
 class TagListFreqPage(Page):
@@ -364,111 +566,134 @@ class TagListFreqPage(Page):
         Page.__init__(self, ctx)
         self.outpath = 'tags-freq.html'
         self.frequent = True
-        self.backdependpages = [ (page, Depend.TAGS|Depend.CREATED) for page in ctx.liveentries ]
+        self.hubdepend = Depend.TAGS|Depend.CREATED
         self.complete()
 
-    def build(self):
+    def stream(self):
         tags = [ (tag, sortform(tag), len(ls)) for tag, ls in self.ctx.entriesbytag.items() ]
         tags.sort(key=lambda tup:(-tup[2], tup[1]))
         
-        fl = self.openwrite()
         template = self.jenv.get_template('tagsfreq.html')
-        fl.write(template.render(
+        return template.generate(
             title='All Tags (by Frequency)',
             tags=tags,
             sortby='freq',
-            recentfew=self.ctx.recentfew))
-        fl.close()
+            recentfew=self.ctx.recentfew)
 
 
 class TagPage(Page):
-    def __init__(self, ctx, tag, pagels):
+    def __init__(self, ctx, tag, pagels, chunk=None):
         Page.__init__(self, ctx)
         self.tag = tag
-        self.outpath = os.path.join('tag', tagfilename(tag)+'.html')
+        self.pagels = pagels
+        self.setchunk(os.path.join('tag', tagfilename(tag)+'.html'), chunk)
         self.backdependpages = [ (page, Depend.TAGS|Depend.PUBDATE|Depend.TITLE) for page in pagels ]
         self.complete()
 
     def __repr__(self):
+        if self.chunknum is not None:
+            return '<%s "%s" %d/%d>' % (self.__class__.__name__, self.tag, self.chunknum, self.chunkcount)
         return '<%s "%s">' % (self.__class__.__name__, self.tag)
 
-    def build(self):
-        entries = self.ctx.entriesbytag[self.tag]
-        entries.reverse()
-        oneentry = (len(entries) == 1)
+    def showscount(self):
+        # Only the main page shows the total number of entries, so that
+        # a new entry doesn't change the older chunks.
+        return (self.chunknum is None or self.outpath == self.baseoutpath)
+
+    def layout(self):
+        res = Page.layout(self)
+        if res is not None and self.showscount():
+            res.append(len(self.ctx.entriesbytag[self.tag]))
+        return res
+
+    def stream(self):
+        entries = list(reversed(self.pagels))
+        entrycount = None
+        oneentry = False
+        if self.showscount():
+            entrycount = len(self.ctx.entriesbytag[self.tag])
+            oneentry = (entrycount == 1)
         
-        fl = self.openwrite()
         template = self.jenv.get_template('tag.html')
-        fl.write(template.render(
+        return template.generate(
             title='Tag: '+self.tag,
             tag=self.tag,
             entries=entries,
-            oneentry=oneentry))
-        fl.close()
+            entrycount=entrycount,
+            oneentry=oneentry,
+            **self.chunklinks())
 
 class FeedPage(Page):
-    def __init__(self, ctx, format, outpath, withsuffix=False):
+    def __init__(self, ctx, format, outpath, withsuffix=False, entries=None):
         Page.__init__(self, ctx)
         self.outpath = outpath
         self.format = format
-        entries = self.ctx.liveentries[ -25 : ]
-        self.backdependpages = [ (page, Depend.ALL) for page in entries ]
+        if entries is None:
+            entries = self.ctx.liveentries
+        self.entries = entries[ -FEED_LENGTH : ]
+        self.backdependpages = [ (page, Depend.ALL) for page in self.entries ]
         self.complete()
 
         self.feed_url = self.ctx.serverurl+outpath
         if not withsuffix:
             self.feed_url, _, _ = self.feed_url.rpartition('.')
 
+        self.title = self.ctx.config['blogtitle']
+        self.link = self.ctx.serverurl
+        self.categories = self.ctx.commontags
+
     def __repr__(self):
         return '<%s (%s) "%s">' % (self.__class__.__name__, self.format, self.outuri)
 
-    def build(self):
-        if self.format == FeedType.ATOM:
-            cla = feedgenerator.Atom1Feed
-        elif self.format == FeedType.RSS:
-            cla = feedgenerator.Rss201rev2Feed
-        else:
-            raise RuntimeException('unknown feed format: '+self.format)
+    def prepare(self):
+        # Serialize the feed items here, so that they're shared between
+        # all the feeds (and the feed content is kept in the read cache)
+        # even when the feeds are built in separate worker processes.
+        for entry in self.entries:
+            entry.feeditem(self.format)
+
+    def stream(self):
+        cla = feedclass(self.format)
 
-        commontags = [ tag for tag, ls in self.ctx.entriesbytag.items() if len(ls) > 1 ]
-        commontags.sort()
-        
         feed = cla(
-            title = self.ctx.config['blogtitle'],
-            link = self.ctx.serverurl,
+            title = self.title,
+            link = self.link,
             author_name = self.ctx.config['ownername'],
             description = self.ctx.config['blogsubtitle'],
             feed_url = self.feed_url,
             language = 'en',
-            categories = commontags,
+            categories = self.categories,
         )
 
-        entries = self.ctx.liveentries[ -25 : ]
-        entries.reverse()
-
-        for entry in entries:
-            body = entry.body
-            val = ls_as_value(entry.metadata.get('infeed'))
-            if val in ('f', 'false', 'n', 'no'):
+        for entry in reversed(self.entries):
+            text = entry.feeditem(self.format)
+            if text is None:
                 continue
-            if val == 'break':
-                body = splitatmore(body)
-                if not body:
-                    raise RuntimeException('post has infeed:break but no break')
-            feed.add_item(
-                title = entry.title,
-                description = entry.excerpt,
-                content = absolutizeurls(body, serverurl=self.ctx.serverurl),
-                link = self.ctx.serverurl+entry.outuri,
-                author_name = self.ctx.config['ownername'],
-                categories = entry.tags,
-                pubdate = entry.published,
-                updateddate = entry.updated,
-            )
+            feed.add_prepared(text, **entry.feeditemargs())
         
-        fl = self.openwrite()
-        feed.write(fl, 'utf-8')
-        fl.close()
+        return feed.stream()
+
+
+class TagFeedPage(FeedPage):
+    def __init__(self, ctx, format, tag):
+        self.tag = tag
+        outpath = os.path.join('feeds', 'tag', tagfilename(tag)+'.xml')
+        FeedPage.__init__(self, ctx, format, outpath, withsuffix=True, entries=ctx.entriesbytag[tag])
+        self.title = '%s: %s' % (self.ctx.config['blogtitle'], tag,)
+        self.link = self.ctx.serverurl+'tag/'+tagfilename(tag)
+        self.categories = [ tag ]
+
+    def __repr__(self):
+        return '<%s (%s) "%s">' % (self.__class__.__name__, self.format, self.tag)
+
+
+class YearFeedPage(FeedPage):
+    def __init__(self, ctx, format, year):
+        self.year = year
+        outpath = os.path.join('feeds', 'year', '%d.xml' % (year,))
+        FeedPage.__init__(self, ctx, format, outpath, withsuffix=True, entries=ctx.entriesbyyear[year])
+        self.title = '%s: %d' % (self.ctx.config['blogtitle'], year,)
+        self.link = self.ctx.serverurl+'%d/' % (year,)
 
         
 class EntryPage(Page):
@@ -502,6 +727,13 @@ class EntryPage(Page):
         self.commentthread = None
         self.comments = None
         self.fedipostid = None
+
+        # The converted source (body, excerpt), once loaded.
+        self.instat = None
+        self.sourcedat = None
+
+        # Serialized feed items, by FeedType; see feeditem().
+        self.feeditems = {}
         
         self.publishedraw = None
         self.published = None
@@ -517,32 +749,21 @@ class EntryPage(Page):
         return '<%s%s "%s">' % (self.__class__.__name__, val, self.outuri)
 
     def read(self):
-        stat = os.stat(self.path)
+        stat = self.ctx.statfile(self.path)
         self.inmodtime = stat.st_mtime
-        
-        if self.type == FileType.HTML:
-            mfl = MetaFile(self.path)
-            body, metadata = mfl.read()
-        elif self.type == FileType.TXT:
-            mfl = MetaFile(self.path)
-            body, metadata = mfl.read()
-            val = str(markupsafe.escape(body))
-            body = '<div class="PreWrapAll">\n%s</div>' % (val,)
-        elif self.type == FileType.MD:
-            fl = open(self.path)
-            dat = fl.read()
-            fl.close()
-            self.mdenv.reset()
-            body = self.mdenv.convert(dat)
-            metadata = self.mdenv.Meta
+        self.instat = stat
+
+        # If the converted source is at hand (cached or prefetched), we
+        # take it now. Otherwise we only read the metadata; the body is
+        # converted when something asks for it.
+        self.sourcedat = None
+        if self.hassource(stat):
+            self.sourcedat = self.loadsource(stat)
+            metadata = self.sourcedat['metadata']
         else:
-            raise RuntimeException(self.path+': Unrecognized entry format: ' + self.type)
-
-        self.body = body
+            metadata = readsourcemeta(self.path, self.type)
         self.metadata = metadata
 
-        self.excerpt = excerpthtml(body)
-
         self.title = None
         ls = metadata.get('title', None)
         if ls:
@@ -624,12 +845,101 @@ class EntryPage(Page):
 
         # shortdate doesn't always match outdir, so we don't check that.
 
+    def derivesource(self, dat):
+        dat['excerpt'] = excerpthtml(dat['body'])
+
+    def getsourcedat(self):
+        if self.sourcedat is None:
+            self.sourcedat = self.loadsource(self.instat)
+        return self.sourcedat
+
+    @property
+    def body(self):
+        return self.getsourcedat()['body']
+
+    @property
+    def excerpt(self):
+        return self.getsourcedat()['excerpt']
+
+    @property
+    def feedcontent(self):
+        """The entry's content as it appears in feeds: absolutized, and
+        cut off at the break if the entry says "infeed: break". None if
+        the entry says "infeed: no".
+
+        This is kept with the converted source, so it's computed once
+        and shared by all the feeds (and saved in the read cache). The
+        serverurl is recorded with it, in case that changes.
+        """
+        dat = self.getsourcedat()
+        res = dat.get('feed')
+        if res is None or res['serverurl'] != self.ctx.serverurl:
+            res = {
+                'serverurl': self.ctx.serverurl,
+                'content': self.makefeedcontent(dat['body']),
+            }
+            dat['feed'] = res
+            if self.ctx.readcache:
+                self.ctx.readcache.dirty = True
+        return res['content']
+
+    def makefeedcontent(self, body):
+        val = ls_as_value(self.metadata.get('infeed'))
+        if val in ('f', 'false', 'n', 'no'):
+            return None
+        if val == 'break':
+            body = splitatmore(body)
+            if not body:
+                raise RuntimeException(self.path+': post has infeed:break but no break')
+        return absolutizeurls(body, serverurl=self.ctx.serverurl)
+
+    def feeditemargs(self):
+        """The arguments for adding this entry to a feed.
+        """
+        return {
+            'title': self.title,
+            'description': self.excerpt,
+            'content': self.feedcontent,
+            'link': self.ctx.serverurl+self.outuri,
+            'author_name': self.ctx.config['ownername'],
+            'categories': self.tags,
+            'pubdate': self.published,
+            'updateddate': self.updated,
+        }
+
+    def feeditem(self, format):
+        """The entry's feed item, serialized in the given format, or None
+        if the entry stays out of feeds. Every feed which includes the
+        entry uses this same text.
+        """
+        if format not in self.feeditems:
+            text = None
+            if self.feedcontent is not None:
+                text = serializeitem(format, self.feeditemargs())
+            self.feeditems[format] = text
+        return self.feeditems[format]
+
+    @property
+    def summarykey(self):
+        """Everything that appears in the entry's summary on index pages
+        (title, date, tags, comment count). Templates use this as the
+        key when caching the summary fragment, so the fragment is
+        rendered once per build and re-rendered if any of these change.
+        """
+        comt = self.commentthread
+        return (
+            self.outuri, self.title, tuple(self.tags),
+            self.publishedraw, self.updatedraw,
+            (len(self.comments) if self.comments else 0),
+            (comt.latestpublished if comt else None),
+        )
+
     def addcomments(self, comt):
         self.comments = comt.comments
         if comt.inmodtime is not None and comt.inmodtime > self.inmodtime:
             self.inmodtime = comt.inmodtime
         
-    def build(self):
+    def stream(self):
         preventry = None
         nextentry = None
         if self.live and self.index > 0:
@@ -637,18 +947,98 @@ class EntryPage(Page):
         if self.live and self.index < len(self.ctx.liveentries)-1:
             nextentry = self.ctx.liveentries[self.index+1]
 
-        fl = self.openwrite()
         template = self.jenv.get_template('entry.html')
-        fl.write(template.render(
+        return template.generate(
             entry=self,
             title=self.title,
             nextentry=nextentry,
-            preventry=preventry))
-        fl.close()
-
+            preventry=preventry)
+
+
+def readsame(fl, text):
+    """Read the next len(text) characters of fl, and check that they
+    match text. If text is None, check that fl is at its end.
+    """
+    try:
+        if text is None:
+            return (fl.read(1) == '')
+        return (fl.read(len(text)) == text)
+    except UnicodeDecodeError:
+        return False
 
-from bloggor.constants import FileType, FeedType, Depend
+def paginate(ls, pagesize):
+    """Split a list of entries (oldest first) into chunks of pagesize.
+    The chunks are counted from the oldest entry, so adding an entry
+    only changes the newest chunk (or starts a new one). Returns a
+    list of (chunk, entries), where chunk is as for Page.setchunk().
+    """
+    if not pagesize or len(ls) <= pagesize:
+        return [ (None, ls) ]
+    chunks = [ ls[ pos : pos+pagesize ] for pos in range(0, len(ls), pagesize) ]
+    count = len(chunks)
+    res = [ ((ix+1, count, False), chunk) for ix, chunk in enumerate(chunks) ]
+    res.append( ((count, count, True), chunks[-1]) )
+    return res
+
+def chunkoutpath(outpath, num):
+    """The outpath of one chunk of a paginated page:
+    "tag/foo.html" becomes "tag/foo/2.html", "2023/index.html" becomes
+    "2023/page/2.html".
+    """
+    base, _, suffix = outpath.rpartition('.')
+    if base.endswith('/index'):
+        base = base[ : -5 ] + 'page'
+    return '%s/%d.%s' % (base, num, suffix)
+
+def linkuri(outpath):
+    """The URI to link to a page, given its outpath.
+    """
+    uri, _, _ = outpath.rpartition('.')
+    if uri == 'index' or uri.endswith('/index'):
+        uri = uri[ : -5 ]
+    return uri
+
+
+def readsourcefile(path, type, mdenv):
+    """Read a page or entry source file. Returns (body, metadata), where
+    the body has been converted to HTML.
+    """
+    if type == FileType.HTML:
+        mfl = MetaFile(path)
+        body, metadata = mfl.read()
+    elif type == FileType.TXT:
+        mfl = MetaFile(path)
+        body, metadata = mfl.read()
+        val = str(markupsafe.escape(body))
+        body = '<div class="PreWrapAll">\n%s</div>' % (val,)
+    elif type == FileType.MD:
+        fl = open(path)
+        dat = fl.read()
+        fl.close()
+        mdenv.reset()
+        body = mdenv.convert(dat)
+        metadata = mdenv.Meta
+    else:
+        raise RuntimeException(path+': Unrecognized entry format: ' + type)
+    return body, metadata
+
+
+def readsourcemeta(path, type):
+    """Read just the metadata of a page or entry source file, without
+    reading or converting the body.
+    """
+    if type == FileType.HTML or type == FileType.TXT:
+        mfl = MetaFile(path)
+        return mfl.readmeta()
+    elif type == FileType.MD:
+        return readmdmeta(path)
+    else:
+        raise RuntimeException(path+': Unrecognized entry format: ' + type)
+
+
+from bloggor.constants import FileType, Depend
 from bloggor.constants import eastern_tz
 from bloggor.excepts import RuntimeException
-from bloggor.metafile import MetaFile, ls_as_bool, ls_as_value
+from bloggor.feeds import feedclass, serializeitem
+from bloggor.metafile import MetaFile, readmdmeta, ls_as_bool, ls_as_value
 from bloggor.util import tagfilename, parsedate, relativetime, excerpthtml, sortform, absolutizeurls, splitatmore
@@ -0,0 +1,64 @@
+import os
+import os.path
+import collections
+
+# The parts of a stat result that we use. The field names match
+# os.stat_result, so this can stand in for one.
+FileStat = collections.namedtuple('FileStat', [ 'st_mtime', 'st_size' ])
+
+class Snapshot:
+    """The files under one or more directory trees, with their sizes and
+    mtimes, collected in one pass with os.scandir(). Reading and the
+    manifest check take their stat information from here, rather than
+    statting each file again.
+    """
+    def __init__(self, topdirs=[]):
+        # { dirpath: [ filename ] }
+        self.dirs = {}
+        # { path: FileStat }
+        self.stats = {}
+        for topdir in topdirs:
+            self.scan(topdir)
+
+    def scan(self, dirpath):
+        try:
+            it = os.scandir(dirpath)
+        except FileNotFoundError:
+            return
+        filenames = []
+        subdirs = []
+        with it:
+            for ent in it:
+                # Like os.walk(), don't descend into symlinked directories.
+                if ent.is_dir(follow_symlinks=False):
+                    subdirs.append(ent.path)
+                    continue
+                try:
+                    stat = ent.stat()
+                except FileNotFoundError:
+                    continue
+                if ent.is_dir():
+                    continue
+                filenames.append(ent.name)
+                self.stats[ent.path] = FileStat(stat.st_mtime, stat.st_size)
+        self.dirs[dirpath] = filenames
+        for subdir in subdirs:
+            self.scan(subdir)
+
+    def walk(self, topdir):
+        """Yield (dirpath, filenames) for every directory in the given
+        tree, in the manner of os.walk().
+        """
+        prefix = topdir + os.sep
+        for dirpath, filenames in self.dirs.items():
+            if dirpath == topdir or dirpath.startswith(prefix):
+                yield (dirpath, filenames)
+
+    def stat(self, path):
+        """Return the FileStat for a file. Files which weren't seen by
+        the scan are statted now.
+        """
+        stat = self.stats.get(path)
+        if stat is None:
+            stat = os.stat(path)
+        return stat
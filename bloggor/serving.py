@@ -0,0 +1,410 @@
+import os
+import os.path
+import time
+import datetime
+import mimetypes
+import posixpath
+import threading
+import collections
+import email.utils
+import urllib.parse
+
+# Don't check for a new build more often than this, in seconds.
+ROUTE_REFRESH_INTERVAL = 0.5
+
+# The Cache-Control header for each path prefix, for servesite.py.
+# The longest matching prefix wins; the empty prefix covers everything
+# else (which is mostly HTML pages).
+default_cache_control = {
+    'css/': 'public, max-age=3600',
+    'js/': 'public, max-age=3600',
+    'feeds/': 'public, max-age=300',
+    '': 'no-cache',
+}
+
+class CachePolicy:
+    """Maps output paths to Cache-Control headers, by path prefix.
+    """
+    def __init__(self, rules=None):
+        self.rules = dict(default_cache_control)
+        if rules:
+            self.rules.update(rules)
+        # Longest first.
+        self.prefixes = sorted(self.rules.keys(), key=lambda val:-len(val))
+
+    def get(self, relpath):
+        for prefix in self.prefixes:
+            if relpath.startswith(prefix):
+                return self.rules[prefix]
+        return None
+
+def parsecachecontrol(ls):
+    """Parse a list of PREFIX=VALUE strings (from the command line) into
+    a dict of rules.
+    """
+    res = {}
+    for val in ls:
+        prefix, eq, header = val.partition('=')
+        if not eq:
+            raise ValueError('cache-control rule must be PREFIX=VALUE: '+val)
+        res[prefix.lstrip('/')] = header.strip()
+    return res
+
+# A file to serve. stat is a FileStat; siblings is { encoding: FileStat }
+# for its compressed siblings.
+Route = collections.namedtuple('Route', [ 'relpath', 'stat', 'ctype', 'siblings' ])
+
+class RouteTable:
+    """Maps request paths to files in the destination directory, with
+    the clean-URL rules: "/foo" serves foo.html, "/dir/" serves
+    dir/index.html, and "/dir" redirects to "/dir/". If both foo.html
+    and a foo directory exist (as with paginated tag pages), "/foo"
+    serves foo.html. Dotfiles (such as the build manifest) and
+    compressed siblings are never served directly.
+
+    The table is built from one scan of the directory, so resolving a
+    request is a dict lookup. It's rebuilt when a full or automatic
+    build commits (which is to say, when the manifest or the --atomic
+    symlink changes), or when FileSite.respond() finds that a file has
+    changed behind its back. Builds of named pages don't touch the manifest, so
+    a request which misses the table checks whether the file it wants
+    has appeared since; see probe().
+    """
+    def __init__(self, destdir):
+        self.destdir = destdir
+        self.lock = threading.Lock()
+        # { urlpath: Route }
+        self.routes = {}
+        # { urlpath: urlpath }
+        self.redirects = {}
+        # Every file seen by the scan, as relpaths.
+        self.files = set()
+        self.stamp = None
+        self.lastcheck = 0
+        self.lastprobe = 0
+        self.load()
+
+    def buildstamp(self):
+        try:
+            stat = os.stat(os.path.join(self.destdir, MANIFEST_NAME))
+            manstamp = (stat.st_mtime, stat.st_size)
+        except FileNotFoundError:
+            manstamp = None
+        return (os.path.realpath(self.destdir), manstamp)
+
+    def load(self):
+        stamp = self.buildstamp()
+        snapshot = Snapshot([ self.destdir ])
+        files = {}
+        for path, stat in snapshot.stats.items():
+            relpath = os.path.relpath(path, start=self.destdir).replace(os.sep, '/')
+            files[relpath] = stat
+        dirs = set()
+        for dirpath in snapshot.dirs:
+            relpath = os.path.relpath(dirpath, start=self.destdir).replace(os.sep, '/')
+            if relpath != '.':
+                dirs.add(relpath)
+
+        suffixes = [ suffix for enc, suffix in encoding_suffixes ]
+        routes = {}
+        for relpath, stat in files.items():
+            filename = posixpath.basename(relpath)
+            if filename.startswith('.'):
+                continue
+            if any([ relpath.endswith(suffix) and relpath[ : -len(suffix) ] in files for suffix in suffixes ]):
+                continue
+            siblings = {}
+            for enc, suffix in encoding_suffixes:
+                if relpath+suffix in files:
+                    siblings[enc] = files[relpath+suffix]
+            ctype, _ = mimetypes.guess_type(relpath)
+            routes['/'+relpath] = Route(relpath, stat, ctype or 'application/octet-stream', siblings)
+
+        # Clean URLs. These never displace an actual file.
+        for relpath, route in list(routes.items()):
+            if relpath.endswith('.html'):
+                routes.setdefault(relpath[ : -5 ], route)
+            if relpath.endswith('/index.html'):
+                routes.setdefault(relpath[ : -10 ], route)
+        redirects = {}
+        for relpath in dirs:
+            if '/'+relpath not in routes:
+                redirects['/'+relpath] = '/'+relpath+'/'
+
+        self.routes = routes
+        self.redirects = redirects
+        self.files = set(files)
+        self.stamp = stamp
+
+    def refresh(self):
+        """Reload the table if a build has committed since it was loaded.
+        """
+        now = time.time()
+        if now - self.lastcheck < ROUTE_REFRESH_INTERVAL:
+            return
+        with self.lock:
+            self.lastcheck = now
+            if self.buildstamp() != self.stamp:
+                self.load()
+
+    def invalidate(self):
+        # Force a reload on the next refresh().
+        self.stamp = None
+        self.lastcheck = 0
+
+    def lookup(self, url):
+        """Resolve a request URL. Returns ("file", Route),
+        ("redirect", location), or (None, None).
+        """
+        parts = urllib.parse.urlsplit(url)
+        path = urllib.parse.unquote(parts.path)
+        trailing = path.endswith('/')
+        path = posixpath.normpath(path)
+        if path == '.' or path == '//':
+            path = '/'
+        if trailing and not path.endswith('/'):
+            path += '/'
+        res = self.resolve(path, parts)
+        if res[0] is None and self.probe(path):
+            res = self.resolve(path, parts)
+        return res
+
+    def resolve(self, path, parts):
+        route = self.routes.get(path)
+        if route is not None:
+            return ('file', route)
+        if path in self.redirects:
+            location = parts.path + '/'
+            if parts.query:
+                location += '?' + parts.query
+            return ('redirect', location)
+        return (None, None)
+
+    def probe(self, path):
+        """Check whether a file which would answer a request for path
+        has been written since the table was loaded. If so, reload the
+        table and return True. This is rate-limited, so that a stream
+        of bad requests doesn't turn into a stream of stat() calls.
+        """
+        now = time.time()
+        if now - self.lastprobe < ROUTE_REFRESH_INTERVAL:
+            return False
+        self.lastprobe = now
+        relpath = path.lstrip('/')
+        if path.endswith('/'):
+            candidates = [ relpath+'index.html' ]
+        else:
+            candidates = [ relpath, relpath+'.html', relpath+'/index.html' ]
+        for relpath in candidates:
+            if relpath in self.files or posixpath.basename(relpath).startswith('.'):
+                continue
+            if os.path.isfile(os.path.join(self.destdir, relpath)):
+                with self.lock:
+                    self.load()
+                return True
+        return False
+
+class ETagIndex:
+    """Strong ETags for the files in the destination directory.
+
+    The build manifest records the hash, mtime, and size of every page,
+    so those are free while the file still matches. (A build of named
+    pages can rewrite a file without touching the manifest.) Other
+    files are hashed on demand, and the result kept until their mtime
+    or size changes.
+    """
+    def __init__(self, destdir):
+        self.destdir = destdir
+        self.manifestpath = os.path.join(destdir, MANIFEST_NAME)
+        self.manifeststamp = None
+        # { relpath: (mtime, size, hash) }
+        self.manifesthashes = {}
+        # { path: (mtime, size, hash) }
+        self.computed = {}
+
+    def loadmanifest(self):
+        # Reload whenever the manifest file changes.
+        try:
+            stat = os.stat(self.manifestpath)
+            stamp = (stat.st_mtime, stat.st_size)
+        except FileNotFoundError:
+            stamp = None
+        if stamp == self.manifeststamp:
+            return
+        self.manifeststamp = stamp
+        self.manifesthashes = {}
+        if stamp is None:
+            return
+        man = Manifest(self.manifestpath)
+        if man.load():
+            for outpath, rec in man.outputs.items():
+                if rec.get('hash'):
+                    self.manifesthashes[outpath] = (rec.get('mtime'), rec.get('size'), rec['hash'])
+
+    def hash(self, relpath, stat):
+        """Return the content hash of a file (uncompressed), given its
+        path relative to destdir and its stat.
+        """
+        self.loadmanifest()
+        ent = self.manifesthashes.get(relpath)
+        if ent and ent[0] == stat.st_mtime and ent[1] == stat.st_size:
+            return ent[2]
+        path = os.path.join(self.destdir, relpath)
+        ent = self.computed.get(path)
+        if ent and ent[0] == stat.st_mtime and ent[1] == stat.st_size:
+            return ent[2]
+        hash = filehash(path)
+        self.computed[path] = (stat.st_mtime, stat.st_size, hash)
+        return hash
+
+    def etag(self, relpath, stat, encoding=None):
+        """Return the ETag for a file, or for its compressed sibling.
+        Each encoding is a distinct representation, so it gets a
+        distinct tag.
+        """
+        hash = self.hash(relpath, stat)
+        if encoding:
+            return '"%s-%s"' % (hash, encoding,)
+        return '"%s"' % (hash,)
+
+# How a request should be answered; see FileSite.respond(). For a 200,
+# sendpath is the file to send, and sendstat its stat as of the
+# request. Headers don't include Content-Length.
+Response = collections.namedtuple('Response', [ 'status', 'headers', 'sendpath', 'sendstat' ])
+
+class FileSite:
+    """Serves the destination directory: the route table, ETags, and
+    the Cache-Control policy, and the logic that ties them together.
+    servesite.py's threaded handler and the asyncio server both answer
+    requests through this, so they behave the same.
+    """
+    def __init__(self, destdir, cachepolicy=None):
+        self.destdir = destdir
+        self.routes = RouteTable(destdir)
+        self.etags = ETagIndex(destdir)
+        self.cachepolicy = cachepolicy or CachePolicy()
+
+    def respond(self, url, headers):
+        """Work out the response to a GET or HEAD request, given the
+        request URL and headers. If the build wrote compressed siblings
+        (.br, .gz) of the file, the one the client prefers is chosen.
+        Conditional requests get a 304.
+
+        The file is stat()ed afresh, rather than trusting the route
+        table, so the ETag and Last-Modified are never stale.
+        """
+        self.routes.refresh()
+        kind, val = self.routes.lookup(url)
+        if kind is None:
+            return Response(404, [], None, None)
+        if kind == 'redirect':
+            return Response(301, [ ('Location', val) ], None, None)
+        
+        route = val
+        path = os.path.join(self.destdir, route.relpath)
+        stat = freshstat(path)
+        if stat is None:
+            self.routes.invalidate()
+            return Response(404, [], None, None)
+        if statchanged(stat, route.stat):
+            # Rewritten without a build committing (e.g. a build of
+            # named pages). Reload the table on the next request.
+            self.routes.invalidate()
+        sendpath = path
+        sendstat = stat
+        enc = chooseencoding(headers.get('Accept-Encoding'), list(route.siblings))
+        if enc:
+            encpath = path + dict(encoding_suffixes)[enc]
+            encstat = freshstat(encpath)
+            if statchanged(encstat, route.siblings[enc]):
+                self.routes.invalidate()
+            if encstat is None or encstat.st_mtime < stat.st_mtime:
+                # Gone, or older than the file; send the file itself.
+                enc = None
+            else:
+                sendpath = encpath
+                sendstat = encstat
+
+        etag = self.etags.etag(route.relpath, stat, enc)
+        resheaders = []
+        if route.siblings:
+            resheaders.append( ('Vary', 'Accept-Encoding') )
+        resheaders.append( ('ETag', etag) )
+        cachecontrol = self.cachepolicy.get(route.relpath)
+        if cachecontrol:
+            resheaders.append( ('Cache-Control', cachecontrol) )
+        
+        if notmodified(headers, etag, stat.st_mtime):
+            return Response(304, resheaders, None, None)
+        
+        resheaders.append( ('Content-Type', route.ctype) )
+        if enc:
+            resheaders.append( ('Content-Encoding', enc) )
+        resheaders.append( ('Last-Modified', email.utils.formatdate(stat.st_mtime, usegmt=True)) )
+        return Response(200, resheaders, sendpath, sendstat)
+
+    def openbody(self, res):
+        """Open the file for a 200 response. Returns (file, size).
+
+        If the file has changed since respond() looked at it, it's sent
+        anyway, and the table is reloaded for the next request. Raises
+        OSError if the file has gone away.
+        """
+        try:
+            fl = open(res.sendpath, 'rb')
+        except OSError:
+            self.routes.invalidate()
+            raise
+        stat = os.fstat(fl.fileno())
+        if statchanged(stat, res.sendstat):
+            self.routes.invalidate()
+        return (fl, stat.st_size)
+
+def freshstat(path):
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+def statchanged(stat, oldstat):
+    if stat is None or oldstat is None:
+        return True
+    return (stat.st_size != oldstat.st_size or stat.st_mtime != oldstat.st_mtime)
+
+def notmodified(headers, etag, mtime):
+    """Check the conditional headers of a GET or HEAD request. Returns
+    True if a 304 response is appropriate. If-None-Match takes precedence
+    over If-Modified-Since, as RFC 9110 says.
+    """
+    val = headers.get('If-None-Match')
+    if val is not None:
+        val = val.strip()
+        if val == '*':
+            return True
+        for tag in val.split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'):
+                # Weak comparison is fine for GET.
+                tag = tag[2:]
+            if tag == etag:
+                return True
+        return False
+    val = headers.get('If-Modified-Since')
+    if val is not None:
+        try:
+            since = email.utils.parsedate_to_datetime(val)
+        except (TypeError, ValueError, IndexError, OverflowError):
+            return False
+        if since is None:
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=datetime.timezone.utc)
+        # HTTP dates have one-second resolution.
+        return int(mtime) <= since.timestamp()
+    return False
+
+
+from bloggor.manifest import Manifest, MANIFEST_NAME
+from bloggor.cache import filehash
+from bloggor.scan import Snapshot
+from bloggor.compress import encoding_suffixes, chooseencoding
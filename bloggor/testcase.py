@@ -1,9 +1,21 @@
 import unittest
 import datetime
 import io
+import os
+import time
+import types
+import shutil
+import tempfile
+import contextlib
+import email.utils
+import json
+import xml.etree.ElementTree
 import markdown
+import jinja2
+import feedgenerator
 
 from .constants import FileType, parse_filetype
+from .constants import FeedType
 from .constants import Depend, parse_depend
 from .util import parsespecs
 from .util import tagfilename
@@ -13,8 +25,21 @@ from .util import xofypages
 from .util import absolutizeurls
 from .metafile import MetaFile
 from .metafile import MultiMetaFile
-from .pages import PageSet
+from .metafile import readmdmeta
+from .pages import PageSet, PageIndex
+from .pages import paginate, chunkoutpath, linkuri
+from .workers import partition
+from .cache import ReadCache, filehash
+from .context import Context, defaultopts
+from .feeds import JSONFeed, feedclass, serializeitem
+from .compress import parseencodings, chooseencoding, siblingsfresh, processoutput
+from .serving import CachePolicy, parsecachecontrol, notmodified
+from .serving import RouteTable, FileSite
+from .aserve import HotCache
+from .manifest import Manifest, snapshotdiff, MANIFEST_NAME
+from .depgraph import DependGraph
 from .mdextension import extension_list
+from .jextension import FragmentCache, fragmentkey, clearfragments
 
 # Run me with:
 #    python3 -m bloggor.testcase
@@ -268,6 +293,23 @@ class TestMetaFile(unittest.TestCase):
             self.assertEqual(body, 'Line.\nLines.\n')
             self.assertEqual(map, { 'key':['val1', 'val2'], 'long':['this', 'is more', 'stuff'] })
 
+    def test_readmeta(self):
+        for dat in [ testnomap1, testnomap2, test1, test2, test3 ]:
+            with io.StringIO(dat) as fl:
+                _, fullmap = MetaFile(None, stream=fl).read()
+            with io.StringIO(dat) as fl:
+                map = MetaFile(None, stream=fl).readmeta()
+                self.assertEqual(map, fullmap)
+
+    def test_mdmeta(self):
+        mdenv = markdown.Markdown(extensions=['meta'])
+        for dat in [ testnomap1, testnomap2, test1, test2, test3, 'key:\tvalue\n more\n\nLines.\n', '' ]:
+            mdenv.reset()
+            mdenv.convert(dat)
+            with io.StringIO(dat) as fl:
+                map = readmdmeta(stream=fl)
+            self.assertEqual(map, mdenv.Meta)
+
     def test_init(self):
         mf = MetaFile(init=( 'hello', { 'x':[1], 'y':[2,22] } ))
         body, map = mf.read()
@@ -506,6 +548,696 @@ class TestPageSet(unittest.TestCase):
         self.assertEqual(len(ps), 3)
 
 
+class TestPageIndex(unittest.TestCase):
+    class MockPage:
+        def __init__(self, outpath, inpath=None, inmodtime=None):
+            self.outpath = outpath
+            self.outuri, _, _ = outpath.rpartition('.')
+            self.inpath = inpath
+            self.inmodtime = inmodtime
+            self.changedep = None
+        def __repr__(self):
+            return '<MockPage "%s">' % (self.outpath,)
+
+    def setUp(self):
+        MockPage = TestPageIndex.MockPage
+        self.pages = [
+            MockPage('index.html'),
+            MockPage('2023/07/foo.html', 'entries/2023/07/foo.md', 100),
+            MockPage('2023/07/bar.html', 'entries/2023/07/bar.html', 200),
+            MockPage('2023/08/foo.html', 'entries/2023/08/foo.md', 300),
+            MockPage('about.html', 'pages/about.md', 100),
+            MockPage('feeds/posts/default.xml'),
+            MockPage('feeds/posts/default.rss'),
+        ]
+        self.index = PageIndex(self.pages)
+
+    def match(self, spec):
+        return [ page.outpath for page in self.index.match(spec) ]
+
+    def test_match(self):
+        self.assertEqual(self.match('index.html'), ['index.html'])
+        self.assertEqual(self.match('index'), ['index.html'])
+        self.assertEqual(self.match('2023/07/foo'), ['2023/07/foo.html'])
+        self.assertEqual(self.match('foo.md'), ['2023/07/foo.html', '2023/08/foo.html'])
+        self.assertEqual(self.match('08/foo.md'), ['2023/08/foo.html'])
+        self.assertEqual(self.match('oo.md'), ['2023/07/foo.html', '2023/08/foo.html'])
+        self.assertEqual(self.match('foo'), [])
+        self.assertEqual(self.match('about.md'), ['about.html'])
+        self.assertEqual(self.match('feeds/posts/default'), ['feeds/posts/default.xml', 'feeds/posts/default.rss'])
+        self.assertEqual(self.match('feeds/posts/default.rss'), ['feeds/posts/default.rss'])
+        self.assertEqual(self.match('2023/*'), ['2023/07/bar.html', '2023/07/foo.html', '2023/08/foo.html'])
+        self.assertEqual(self.match('2023/0[8]/*'), ['2023/08/foo.html'])
+        self.assertEqual(self.match('*/foo'), ['2023/07/foo.html', '2023/08/foo.html'])
+        self.assertEqual(self.match('x*'), [])
+
+    def test_matchspecs(self):
+        res = self.index.matchspecs(parsespecs(['about', '2023/07/foo:title', 'foo.md:tags']))
+        self.assertEqual(res, [
+            (self.pages[1], Depend.TITLE|Depend.TAGS),
+            (self.pages[3], Depend.TAGS),
+            (self.pages[4], Depend.ALL),
+        ])
+        res = self.index.matchspecs(parsespecs(['2023/07/foo:title']), recentlimit=250)
+        self.assertEqual(res, [
+            (self.pages[1], Depend.TITLE),
+            (self.pages[3], Depend.ALL),
+        ])
+        # A recent page which a spec names gets both sets of bits.
+        self.pages[3].changedep = Depend.BODY
+        res = self.index.matchspecs(parsespecs(['2023/08/foo:title']), recentlimit=250)
+        self.assertEqual(res, [
+            (self.pages[3], Depend.TITLE|Depend.BODY),
+        ])
+
+
+class TestPaginate(unittest.TestCase):
+    def test(self):
+        self.assertEqual(paginate([], 0), [ (None, []) ])
+        self.assertEqual(paginate([1, 2, 3], 0), [ (None, [1, 2, 3]) ])
+        self.assertEqual(paginate([1, 2, 3], 3), [ (None, [1, 2, 3]) ])
+        self.assertEqual(paginate([1, 2, 3], 2), [
+            ((1, 2, False), [1, 2]),
+            ((2, 2, False), [3]),
+            ((2, 2, True), [3]),
+        ])
+        self.assertEqual(paginate([1, 2, 3, 4, 5], 2), [
+            ((1, 3, False), [1, 2]),
+            ((2, 3, False), [3, 4]),
+            ((3, 3, False), [5]),
+            ((3, 3, True), [5]),
+        ])
+
+    def test_paths(self):
+        self.assertEqual(chunkoutpath('tag/foo.html', 2), 'tag/foo/2.html')
+        self.assertEqual(chunkoutpath('2023/index.html', 1), '2023/page/1.html')
+        self.assertEqual(chunkoutpath('2023/07/index.html', 12), '2023/07/page/12.html')
+        self.assertEqual(linkuri('tag/foo.html'), 'tag/foo')
+        self.assertEqual(linkuri('tag/foo/2.html'), 'tag/foo/2')
+        self.assertEqual(linkuri('2023/index.html'), '2023/')
+        self.assertEqual(linkuri('index.html'), '')
+
+
+class BuildTestCase(unittest.TestCase):
+    # Helpers for tests which build a small site from scratch.
+    templatesdir = os.path.join(os.path.dirname(__file__), '..', 'sample', 'templates')
+
+    def makesrc(self, tempdir, **config):
+        srcdir = os.path.join(tempdir, 'src')
+        os.makedirs(os.path.join(srcdir, 'entries', '2023', '07'))
+        os.makedirs(os.path.join(srcdir, 'pages'))
+        shutil.copytree(self.templatesdir, os.path.join(srcdir, 'templates'))
+        with open(os.path.join(srcdir, 'bloggor.cfg'), 'w') as fl:
+            fl.write('[bloggor]\n')
+            for key, val in config.items():
+                fl.write('%s = %s\n' % (key, val,))
+        return srcdir
+
+    def entrypath(self, srcdir, num):
+        return os.path.join(srcdir, 'entries', '2023', '07', 'post%d.md' % (num,))
+
+    def writeentry(self, srcdir, num, published=None, tags='foo', extra='', body=None):
+        if published is None:
+            published = '2023-07-%02dT12:00:00Z' % (num,)
+        if body is None:
+            body = 'Post %d.\n' % (num,)
+        with open(self.entrypath(srcdir, num), 'w') as fl:
+            fl.write('---\ntitle: Post %d\ntags: %s\nlive: yes\npublished: %s\n%s---\n\n%s' % (num, tags, published, extra, body,))
+
+    def build(self, srcdir, destdir, pagespecs=[], **kwargs):
+        # Returns the build's output.
+        opts = defaultopts(srcdir=srcdir, destdir=destdir, nocache=True, **kwargs)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            ctx = Context(opts)
+            self.assertTrue(ctx.run(pagespecs))
+        return out.getvalue()
+
+    def readout(self, destdir, outpath):
+        with open(os.path.join(destdir, outpath)) as fl:
+            return fl.read()
+
+class TestPaginateBuild(BuildTestCase):
+    # Build a small site with split tag pages, add entries, and check
+    # that the automatic rebuild updates the chunks that changed, and
+    # only those.
+    def test(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            srcdir = self.makesrc(tempdir, pagesize=2)
+            destdir = os.path.join(tempdir, 'site')
+
+            for num in range(1, 6):
+                self.writeentry(srcdir, num)
+            self.build(srcdir, destdir)
+            self.assertIn('(5)', self.readout(destdir, 'tag/foo.html'))
+            self.assertNotIn('(5)', self.readout(destdir, 'tag/foo/1.html'))
+            self.assertNotIn('href="/tag/foo/4"', self.readout(destdir, 'tag/foo/3.html'))
+            self.assertFalse(os.path.exists(os.path.join(destdir, 'tag/foo/4.html')))
+
+            # Post 6 fills chunk 3.
+            self.writeentry(srcdir, 6)
+            out = self.build(srcdir, destdir)
+            self.assertIn('.../tag/foo.html', out)
+            self.assertIn('.../tag/foo/3.html', out)
+            self.assertNotIn('.../tag/foo/1.html', out)
+
+            # Post 7 starts chunk 4, which changes the links of chunk 3.
+            self.writeentry(srcdir, 7)
+            out = self.build(srcdir, destdir)
+            self.assertIn('.../tag/foo/3.html', out)
+            self.assertIn('.../tag/foo/4.html', out)
+            self.assertNotIn('.../tag/foo/1.html', out)
+            self.assertNotIn('.../tag/foo/2.html', out)
+            self.assertIn('(7)', self.readout(destdir, 'tag/foo.html'))
+            self.assertIn('href="/tag/foo/4"', self.readout(destdir, 'tag/foo/3.html'))
+            self.assertIn('href="/tag/foo/3"', self.readout(destdir, 'tag/foo/4.html'))
+            self.assertIn('Post 7', self.readout(destdir, 'tag/foo.html'))
+
+            # Deleting post 7 removes chunk 4 again.
+            os.remove(self.entrypath(srcdir, 7))
+            self.build(srcdir, destdir)
+            self.assertIn('(6)', self.readout(destdir, 'tag/foo.html'))
+            self.assertNotIn('href="/tag/foo/4"', self.readout(destdir, 'tag/foo/3.html'))
+            self.assertFalse(os.path.exists(os.path.join(destdir, 'tag/foo/4.html')))
+
+
+class TestRecentBuild(BuildTestCase):
+    # Move an entry in the order, and check that a --recent build
+    # updates the prev/next links of its old and new neighbors.
+    def test(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            srcdir = self.makesrc(tempdir)
+            destdir = os.path.join(tempdir, 'site')
+            for num in range(1, 5):
+                self.writeentry(srcdir, num)
+            self.build(srcdir, destdir)
+            self.assertIn('rel="next" href="/2023/07/post4"', self.readout(destdir, '2023/07/post3.html'))
+
+            # Only the edited entry counts as recent.
+            oldtime = time.time() - 7200
+            for num in range(1, 5):
+                os.utime(self.entrypath(srcdir, num), (oldtime, oldtime))
+            # The order was 1, 2, 3, 4; now it's 1, 4, 2, 3.
+            self.writeentry(srcdir, 4, published='2023-07-01T18:00:00Z')
+            self.build(srcdir, destdir, recent='1h')
+            self.assertIn('rel="next" href="/2023/07/post4"', self.readout(destdir, '2023/07/post1.html'))
+            self.assertIn('rel="prev" href="/2023/07/post4"', self.readout(destdir, '2023/07/post2.html'))
+            self.assertNotIn('rel="next"', self.readout(destdir, '2023/07/post3.html'))
+
+
+class TestManifestHashes(BuildTestCase):
+    # The manifest's output hashes must match the files, even when a
+    # build of named pages has rewritten some of them in between.
+    def checkhashes(self, destdir):
+        man = Manifest(os.path.join(destdir, MANIFEST_NAME))
+        self.assertTrue(man.load())
+        for outpath, rec in man.outputs.items():
+            self.assertEqual(rec['hash'], filehash(os.path.join(destdir, outpath)), outpath)
+
+    def test(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            srcdir = self.makesrc(tempdir)
+            destdir = os.path.join(tempdir, 'site')
+            for num in range(1, 4):
+                self.writeentry(srcdir, num)
+            self.build(srcdir, destdir)
+            self.checkhashes(destdir)
+
+            self.writeentry(srcdir, 2, body='Post 2, edited.\n')
+            self.build(srcdir, destdir, ['post2.md'])
+            # Stand-in for a page which the named build rewrote, but
+            # the next automatic build doesn't need to.
+            path = os.path.join(destdir, 'tag', 'foo.html')
+            with open(path, 'a') as fl:
+                fl.write('<!-- edited -->\n')
+            self.build(srcdir, destdir)
+            self.checkhashes(destdir)
+
+
+class TestFeeds(BuildTestCase):
+    def feedargs(self, num, tags):
+        return {
+            'title': 'Post %d' % (num,),
+            'description': 'Summary <i>%d</i>' % (num,),
+            'content': '<p>Post &amp; %d.</p>' % (num,),
+            'link': 'https://blog.example.com/2023/07/post%d' % (num,),
+            'author_name': 'Owner',
+            'categories': tags,
+            'pubdate': datetime.datetime(2023, 7, num, 12, tzinfo=datetime.timezone.utc),
+            'updateddate': None,
+        }
+
+    def test_prepared(self):
+        # A feed built from prepared items must match the plain
+        # feedgenerator output, byte for byte.
+        itemls = [ self.feedargs(2, ['foo', 'bar']), self.feedargs(1, []) ]
+        for format, plaincla in [ (FeedType.ATOM, feedgenerator.Atom1Feed), (FeedType.RSS, feedgenerator.Rss201rev2Feed) ]:
+            feedargs = {
+                'title': 'Blog',
+                'link': 'https://blog.example.com/',
+                'description': 'Some words',
+                'author_name': 'Owner',
+                'feed_url': 'https://blog.example.com/feeds/posts/default',
+                'language': 'en',
+                'categories': ['foo'],
+            }
+            plain = plaincla(**feedargs)
+            prepared = feedclass(format)(**feedargs)
+            for args in itemls:
+                plain.add_item(**args)
+                prepared.add_prepared(serializeitem(format, args), **args)
+            self.assertEqual(''.join(prepared.stream()), plain.writeString('utf-8'))
+
+    def feedlinks(self, destdir, outpath):
+        root = xml.etree.ElementTree.fromstring(self.readout(destdir, outpath))
+        ns = '{http://www.w3.org/2005/Atom}'
+        return [ ent.find(ns+'link').get('href') for ent in root.findall(ns+'entry') ]
+
+    def test_tagyear(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            srcdir = self.makesrc(tempdir, tagfeeds='yes', yearfeeds='yes')
+            destdir = os.path.join(tempdir, 'site')
+            self.writeentry(srcdir, 1, tags='foo', published='2022-12-01T12:00:00Z')
+            self.writeentry(srcdir, 2, tags='foo, bar')
+            self.writeentry(srcdir, 3, tags='bar')
+            self.build(srcdir, destdir)
+            url = 'https://blog.example.com/2023/07/post%d'
+            self.assertEqual(self.feedlinks(destdir, 'feeds/posts/default.xml'), [ url % (3,), url % (2,), url % (1,) ])
+            self.assertEqual(self.feedlinks(destdir, 'feeds/tag/foo.xml'), [ url % (2,), url % (1,) ])
+            self.assertEqual(self.feedlinks(destdir, 'feeds/tag/bar.xml'), [ url % (3,), url % (2,) ])
+            self.assertEqual(self.feedlinks(destdir, 'feeds/year/2023.xml'), [ url % (3,), url % (2,) ])
+            self.assertEqual(self.feedlinks(destdir, 'feeds/year/2022.xml'), [ url % (1,) ])
+
+
+class TestJSONFeed(BuildTestCase):
+    def test_empty(self):
+        feed = JSONFeed(title='Blog', link='https://blog.example.com/', description='')
+        dat = json.loads(''.join(feed.stream()))
+        self.assertEqual(dat, {
+            'version': 'https://jsonfeed.org/version/1.1',
+            'title': 'Blog',
+            'home_page_url': 'https://blog.example.com/',
+            'items': [],
+        })
+
+    def test_build(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            srcdir = self.makesrc(tempdir)
+            destdir = os.path.join(tempdir, 'site')
+            self.writeentry(srcdir, 1)
+            self.writeentry(srcdir, 2, extra='infeed: no\n')
+            self.writeentry(srcdir, 3, extra='infeed: break\n', body='Before the break.\n\n- - -\n\nAfter the break.\n')
+            self.build(srcdir, destdir)
+            
+            dat = json.loads(self.readout(destdir, 'feeds/posts/default.json'))
+            self.assertEqual(dat['version'], 'https://jsonfeed.org/version/1.1')
+            self.assertEqual(dat['title'], 'Blog')
+            self.assertEqual(dat['home_page_url'], 'https://blog.example.com/')
+            self.assertEqual(dat['feed_url'], 'https://blog.example.com/feeds/posts/default.json')
+            self.assertEqual(dat['authors'], [ { 'name': 'Owner' } ])
+
+            # Newest first, and post 2 is left out.
+            items = dat['items']
+            self.assertEqual([ item['id'] for item in items ], [ 'https://blog.example.com/2023/07/post3', 'https://blog.example.com/2023/07/post1' ])
+            for item in items:
+                for key in [ 'id', 'url', 'title', 'content_html', 'date_published', 'tags' ]:
+                    self.assertIn(key, item)
+            self.assertEqual(items[1]['title'], 'Post 1')
+            self.assertEqual(items[1]['date_published'], '2023-07-01T12:00:00+00:00')
+            self.assertEqual(items[1]['tags'], ['foo'])
+            self.assertIn('Post 1.', items[1]['content_html'])
+            self.assertIn('Before the break.', items[0]['content_html'])
+            self.assertNotIn('After the break.', items[0]['content_html'])
+
+
+class TestReadCache(unittest.TestCase):
+    def test_dirty(self):
+        ctx = types.SimpleNamespace(serverurl='https://blog.example.com/', config={})
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'post.md')
+            with open(path, 'w') as fl:
+                fl.write('Post.')
+            cachepath = os.path.join(tempdir, 'cache', 'readcache.json')
+            
+            cache = ReadCache(ctx, cachepath)
+            cache.load()
+            self.assertIsNone(cache.get('post.md', path, os.stat(path)))
+            cache.put('post.md', path, os.stat(path), 'data')
+            self.assertTrue(cache.dirty)
+            cache.save()
+            self.assertFalse(cache.dirty)
+
+            # A plain hit leaves nothing to save.
+            cache = ReadCache(ctx, cachepath)
+            cache.load()
+            self.assertEqual(cache.get('post.md', path, os.stat(path)), 'data')
+            cache.prune()
+            self.assertFalse(cache.dirty)
+
+            # A touched file is still a hit, but the new mtime is saved.
+            stat = os.stat(path)
+            os.utime(path, (stat.st_atime, stat.st_mtime+10))
+            cache = ReadCache(ctx, cachepath)
+            cache.load()
+            self.assertEqual(cache.get('post.md', path, os.stat(path)), 'data')
+            self.assertTrue(cache.dirty)
+
+            # An entry for a file which was never read is dropped.
+            cache = ReadCache(ctx, cachepath)
+            cache.load()
+            cache.prune()
+            self.assertTrue(cache.dirty)
+            self.assertEqual(cache.map, {})
+
+
+class TestPartition(unittest.TestCase):
+    def test(self):
+        self.assertEqual(partition([], 4), [[]])
+        self.assertEqual(partition([1], 4), [[1]])
+        self.assertEqual(partition([1, 2, 3], 1), [[1, 2, 3]])
+        self.assertEqual(partition([1, 2, 3], 2), [[1, 3], [2]])
+        self.assertEqual(partition(list(range(10)), 4), [[0, 4, 8], [1, 5, 9], [2, 6], [3, 7]])
+        
+
+class TestCompress(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(parseencodings('no'), [])
+        self.assertEqual(parseencodings(''), [])
+        self.assertEqual(parseencodings('gzip'), ['gzip'])
+        self.assertEqual(parseencodings(' GZIP , gzip'), ['gzip'])
+        with self.assertRaises(Exception):
+            parseencodings('zip')
+
+    def test_fresh(self):
+        with tempfile.TemporaryDirectory() as destdir:
+            path = os.path.join(destdir, 'index.html')
+            with open(path, 'w') as fl:
+                fl.write('<p>Hello.</p>')
+            self.assertTrue(siblingsfresh(path, []))
+            self.assertFalse(siblingsfresh(path, ['gzip']))
+            processoutput(path, ['gzip'])
+            self.assertTrue(os.path.exists(path+'.gz'))
+            self.assertTrue(siblingsfresh(path, ['gzip']))
+            self.assertFalse(siblingsfresh(path, []))
+            self.assertFalse(siblingsfresh(path, ['gzip', 'br']))
+            # The page is rewritten after its sibling.
+            stat = os.stat(path)
+            os.utime(path+'.gz', (stat.st_atime, stat.st_mtime-10))
+            self.assertFalse(siblingsfresh(path, ['gzip']))
+
+    def test_choose(self):
+        self.assertEqual(chooseencoding(None, ['gzip']), None)
+        self.assertEqual(chooseencoding('gzip', []), None)
+        self.assertEqual(chooseencoding('gzip, deflate', ['gzip']), 'gzip')
+        self.assertEqual(chooseencoding('gzip, deflate, br', ['gzip', 'br']), 'br')
+        self.assertEqual(chooseencoding('gzip, br;q=0', ['gzip', 'br']), 'gzip')
+        self.assertEqual(chooseencoding('gzip;q=0', ['gzip']), None)
+        self.assertEqual(chooseencoding('deflate', ['gzip']), None)
+        self.assertEqual(chooseencoding('*', ['gzip']), 'gzip')
+        self.assertEqual(chooseencoding('*, gzip;q=0', ['gzip']), None)
+
+class TestServing(unittest.TestCase):
+    def test_cachepolicy(self):
+        policy = CachePolicy()
+        self.assertEqual(policy.get('css/page.css'), 'public, max-age=3600')
+        self.assertEqual(policy.get('index.html'), 'no-cache')
+        policy = CachePolicy(parsecachecontrol(['css/=max-age=60', '/feeds/posts/=no-store', '=max-age=5']))
+        self.assertEqual(policy.get('css/page.css'), 'max-age=60')
+        self.assertEqual(policy.get('feeds/posts/default.xml'), 'no-store')
+        self.assertEqual(policy.get('feeds/tag/foo.xml'), 'public, max-age=300')
+        self.assertEqual(policy.get('2023/index.html'), 'max-age=5')
+        with self.assertRaises(ValueError):
+            parsecachecontrol(['css/'])
+
+    def test_notmodified(self):
+        mtime = 1700000000.5
+        self.assertFalse(notmodified({}, '"abc"', mtime))
+        self.assertTrue(notmodified({ 'If-None-Match':'"abc"' }, '"abc"', mtime))
+        self.assertTrue(notmodified({ 'If-None-Match':'"x", W/"abc"' }, '"abc"', mtime))
+        self.assertTrue(notmodified({ 'If-None-Match':'*' }, '"abc"', mtime))
+        self.assertFalse(notmodified({ 'If-None-Match':'"x"' }, '"abc"', mtime))
+        self.assertTrue(notmodified({ 'If-Modified-Since':'Tue, 14 Nov 2023 22:13:20 GMT' }, '"abc"', mtime))
+        self.assertFalse(notmodified({ 'If-Modified-Since':'Tue, 14 Nov 2023 22:13:19 GMT' }, '"abc"', mtime))
+        self.assertFalse(notmodified({ 'If-Modified-Since':'garbage' }, '"abc"', mtime))
+        # If-None-Match wins.
+        self.assertFalse(notmodified({ 'If-None-Match':'"x"', 'If-Modified-Since':'Tue, 14 Nov 2023 22:13:20 GMT' }, '"abc"', mtime))
+
+    def test_etag(self):
+        with tempfile.TemporaryDirectory() as destdir:
+            path = os.path.join(destdir, 'page.html')
+            with open(path, 'w') as fl:
+                fl.write('one')
+            stat = os.stat(path)
+            man = Manifest(os.path.join(destdir, MANIFEST_NAME))
+            man.outputs['page.html'] = { 'hash': 'fake', 'mtime': stat.st_mtime, 'size': stat.st_size }
+            man.save()
+            site = FileSite(destdir)
+            res = site.respond('/page', {})
+            self.assertIn(('ETag', '"fake"'), res.headers)
+            res = site.respond('/page', { 'If-None-Match': '"fake"' })
+            self.assertEqual(res.status, 304)
+
+            # Rewritten behind the manifest's back (and the route
+            # table's). The ETag and the 304 must follow the file.
+            with open(path, 'w') as fl:
+                fl.write('two!')
+            os.utime(path, (stat.st_mtime+5, stat.st_mtime+5))
+            res = site.respond('/page', { 'If-None-Match': '"fake"' })
+            self.assertEqual(res.status, 200)
+            self.assertIn(('ETag', '"%s"' % (filehash(path),)), res.headers)
+            self.assertEqual(res.sendstat.st_size, 4)
+            self.assertIn(('Last-Modified', email.utils.formatdate(stat.st_mtime+5, usegmt=True)), res.headers)
+
+    def test_reload(self):
+        with tempfile.TemporaryDirectory() as destdir:
+            path = os.path.join(destdir, 'page.html')
+            with open(path, 'w') as fl:
+                fl.write('one')
+            site = FileSite(destdir)
+            site.respond('/page', {})
+            stamp = site.routes.stamp
+            self.assertIsNotNone(stamp)
+
+            # No manifest change, so only the request can notice.
+            with open(path, 'w') as fl:
+                fl.write('two!')
+            res = site.respond('/page', {})
+            self.assertEqual(res.sendstat.st_size, 4)
+            self.assertIsNone(site.routes.stamp)
+            site.respond('/page', {})
+            self.assertEqual(site.routes.stamp, stamp)
+            self.assertEqual(site.routes.routes['/page'].stat.st_size, 4)
+
+            os.remove(path)
+            res = site.respond('/page', {})
+            self.assertEqual(res.status, 404)
+            site.respond('/page', {})
+            self.assertNotIn('/page', site.routes.routes)
+
+class TestRouteTable(unittest.TestCase):
+    def test(self):
+        with tempfile.TemporaryDirectory() as destdir:
+            for relpath in [ 'index.html', 'about.html', 'about.html.gz', '.manifest.json', 'tag/foo.html', 'tag/foo/1.html', '2023/index.html', 'css/page.css', 'gzonly.gz' ]:
+                path = os.path.join(destdir, relpath)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'w') as fl:
+                    fl.write(relpath)
+            table = RouteTable(destdir)
+
+            def lookup(url):
+                kind, val = table.lookup(url)
+                if kind == 'file':
+                    return val.relpath
+                return (kind, val)
+
+            self.assertEqual(lookup('/'), 'index.html')
+            self.assertEqual(lookup('/about'), 'about.html')
+            self.assertEqual(lookup('/about.html'), 'about.html')
+            self.assertEqual(lookup('/about.html.gz'), (None, None))
+            self.assertEqual(lookup('/gzonly.gz'), 'gzonly.gz')
+            self.assertEqual(lookup('/.manifest.json'), (None, None))
+            self.assertEqual(lookup('/tag/foo'), 'tag/foo.html')
+            self.assertEqual(lookup('/tag/foo/1'), 'tag/foo/1.html')
+            self.assertEqual(lookup('/tag/foo/'), (None, None))
+            self.assertEqual(lookup('/2023'), ('redirect', '/2023/'))
+            self.assertEqual(lookup('/2023?x=1'), ('redirect', '/2023/?x=1'))
+            self.assertEqual(lookup('/2023/'), '2023/index.html')
+            self.assertEqual(lookup('/2023/../about'), 'about.html')
+            self.assertEqual(lookup('/css/page%2Ecss'), 'css/page.css')
+            self.assertEqual(lookup('/nope'), (None, None))
+            self.assertEqual(table.routes['/about'].ctype, 'text/html')
+            self.assertEqual(list(table.routes['/about'].siblings), ['gzip'])
+
+            # A file written without a manifest change (a build of named
+            # pages) is found when a request misses.
+            with open(os.path.join(destdir, 'new.html'), 'w') as fl:
+                fl.write('new')
+            table.lastprobe = 0
+            self.assertEqual(lookup('/new'), 'new.html')
+            os.makedirs(os.path.join(destdir, '2024'))
+            with open(os.path.join(destdir, '2024', 'index.html'), 'w') as fl:
+                fl.write('2024')
+            table.lastprobe = 0
+            self.assertEqual(lookup('/2024'), ('redirect', '/2024/'))
+            # Rate-limited.
+            with open(os.path.join(destdir, 'newer.html'), 'w') as fl:
+                fl.write('newer')
+            self.assertEqual(lookup('/newer'), (None, None))
+
+            # The build manifest is never served, even when it's new.
+            with open(os.path.join(destdir, MANIFEST_NAME), 'w') as fl:
+                fl.write('{}')
+            table.lastprobe = 0
+            self.assertEqual(lookup('/'+MANIFEST_NAME), (None, None))
+            self.assertNotIn('/'+MANIFEST_NAME, table.routes)
+
+class TestHotCache(unittest.TestCase):
+    def test(self):
+        cache = HotCache(maxbytes=10)
+        cache.put('a', b'1234')
+        cache.put('b', b'1234')
+        self.assertEqual(cache.get('a'), b'1234')
+        cache.put('c', b'1234')
+        # 'b' was least recently used.
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), b'1234')
+        self.assertEqual(cache.get('c'), b'1234')
+        self.assertEqual(cache.total, 8)
+        cache.put('a', b'12')
+        self.assertEqual(cache.total, 6)
+        cache.put('d', b'12345678901')
+        self.assertEqual(cache.total, 0)
+        self.assertEqual(cache.get('d'), None)
+
+    def test_entries(self):
+        cache = HotCache(maxbytes=100, maxentries=2)
+        cache.put('a', b'1')
+        cache.put('b', b'2')
+        cache.put('c', b'3')
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), b'2')
+        self.assertEqual(cache.get('c'), b'3')
+        self.assertEqual(len(cache.map), 2)
+        self.assertEqual(cache.total, 2)
+
+class TestSnapshotDiff(unittest.TestCase):
+    base = {
+        'outuri': '2023/07/foo', 'live': True,
+        'title': 'Foo', 'tags': ['one', 'two'],
+        'published': '2023-07-01T12:00:00+00:00',
+        'updated': '2023-07-01T12:00:00+00:00',
+        'body': 'aaa', 'meta': 'bbb', 'comments': None,
+    }
+
+    def diff(self, **kwargs):
+        new = dict(self.base)
+        new.update(kwargs)
+        return snapshotdiff(self.base, new)
+    
+    def test(self):
+        self.assertEqual(snapshotdiff(None, None), Depend.NONE)
+        self.assertEqual(snapshotdiff(None, self.base), Depend.ALL)
+        self.assertEqual(snapshotdiff(self.base, None), Depend.ALL)
+        
+        self.assertEqual(self.diff(), Depend.NONE)
+        self.assertEqual(self.diff(title='Bar'), Depend.TITLE)
+        self.assertEqual(self.diff(tags=['one']), Depend.TAGS)
+        self.assertEqual(self.diff(tags=['two', 'one']), Depend.TAGS)
+        self.assertEqual(self.diff(published='2023-07-02T12:00:00+00:00'), Depend.PUBDATE)
+        self.assertEqual(self.diff(updated='2023-07-02T12:00:00+00:00'), Depend.UPDATE)
+        self.assertEqual(self.diff(body='ccc'), Depend.BODY)
+        self.assertEqual(self.diff(meta='ccc'), Depend.BODY)
+        self.assertEqual(self.diff(comments='ccc'), Depend.COMMENTS)
+        self.assertEqual(self.diff(title='Bar', body='ccc'), Depend.TITLE|Depend.BODY)
+        self.assertEqual(self.diff(live=False), Depend.ALL)
+
+        draft = dict(self.base)
+        draft['live'] = False
+        draft2 = dict(draft)
+        draft2['title'] = 'Bar'
+        self.assertEqual(snapshotdiff(draft, draft2), Depend.NONE)
+        
+
+class TestDependGraph(unittest.TestCase):
+    class MockPage:
+        def __init__(self, outpath, backdependpages=None, hubdepend=None):
+            self.outpath = outpath
+            self.backdependpages = backdependpages
+            self.hubdepend = hubdepend
+            self.chunkseries = None
+        def __repr__(self):
+            return '<MockPage "%s">' % (self.outpath,)
+
+    def dependents(self, graph, entry, dep):
+        return sorted([ page.outpath for page in graph.dependents(entry, dep) ])
+        
+    def test(self):
+        MockPage = TestDependGraph.MockPage
+        ent1 = MockPage('ent1')
+        ent2 = MockPage('ent2')
+        draft = MockPage('draft')
+        ent1.backdependpages = [ (ent2, Depend.TITLE) ]
+        ent2.backdependpages = [ (ent1, Depend.TITLE) ]
+        tag = MockPage('tag', backdependpages=[ (ent1, Depend.ALLBUTBODY) ])
+        feed = MockPage('feed', backdependpages=[ (ent1, Depend.ALL), (ent2, Depend.ALL) ])
+        history = MockPage('history', hubdepend=Depend.CREATED|Depend.PUBDATE)
+        tags = MockPage('tags', hubdepend=Depend.TAGS)
+        
+        graph = DependGraph([ ent1, ent2, draft, tag, feed, history, tags ], [ ent1, ent2 ])
+
+        self.assertEqual(self.dependents(graph, ent1, Depend.NONE), [])
+        self.assertEqual(self.dependents(graph, ent1, Depend.BODY), ['feed'])
+        self.assertEqual(self.dependents(graph, ent1, Depend.TITLE), ['ent2', 'feed', 'tag'])
+        self.assertEqual(self.dependents(graph, ent1, Depend.TAGS), ['feed', 'tag', 'tags'])
+        self.assertEqual(self.dependents(graph, ent2, Depend.TAGS), ['feed', 'tags'])
+        self.assertEqual(self.dependents(graph, ent2, Depend.ALL), ['ent1', 'feed', 'history', 'tags'])
+        self.assertEqual(self.dependents(graph, draft, Depend.ALL), [])
+        self.assertEqual(self.dependents(graph, tag, Depend.ALL), [])
+
+    def test_series(self):
+        MockPage = TestDependGraph.MockPage
+        ent1 = MockPage('ent1')
+        ent2 = MockPage('ent2')
+        ent3 = MockPage('ent3')
+        chunk1 = MockPage('tag/1', backdependpages=[ (ent1, Depend.TAGS|Depend.PUBDATE|Depend.TITLE) ])
+        chunk2 = MockPage('tag/2', backdependpages=[ (ent2, Depend.TAGS|Depend.PUBDATE|Depend.TITLE) ])
+        chunk3 = MockPage('tag/3', backdependpages=[ (ent3, Depend.TAGS|Depend.PUBDATE|Depend.TITLE) ])
+        chunk1.chunkseries = chunk2.chunkseries = chunk3.chunkseries = [ chunk1, chunk2, chunk3 ]
+        
+        graph = DependGraph([ ent1, ent2, ent3, chunk1, chunk2, chunk3 ], [ ent1, ent2, ent3 ])
+
+        self.assertEqual(self.dependents(graph, ent1, Depend.TITLE), ['tag/1'])
+        self.assertEqual(self.dependents(graph, ent2, Depend.TITLE), ['tag/2'])
+        # The chunk before, and the ones after.
+        self.assertEqual(self.dependents(graph, ent3, Depend.TAGS), ['tag/2', 'tag/3'])
+        self.assertEqual(self.dependents(graph, ent3, Depend.ALL), ['tag/2', 'tag/3'])
+        self.assertEqual(self.dependents(graph, ent2, Depend.PUBDATE), ['tag/1', 'tag/2', 'tag/3'])
+        self.assertEqual(self.dependents(graph, ent1, Depend.TAGS), ['tag/1', 'tag/2', 'tag/3'])
+        
+
+class TestFragmentCache(unittest.TestCase):
+    def test_key(self):
+        self.assertEqual(fragmentkey('x'), 'x')
+        self.assertEqual(fragmentkey(['x', [1, 2]]), ('x', (1, 2)))
+        self.assertEqual(fragmentkey({ 'b':[1], 'a':2 }), (('a', 2), ('b', (1,))))
+        self.assertEqual(fragmentkey(set([1])), repr(set([1])))
+
+    def test_cache(self):
+        env = jinja2.Environment(
+            loader = jinja2.DictLoader({
+                'temp': '{% cache "k", ls %}[{{ count.pop() }}{% for x in ls %}{{ x }}{% endfor %}]{% endcache %}',
+            }),
+            extensions = [ FragmentCache ],
+        )
+        temp = env.get_template('temp')
+        count = [ 4, 3, 2, 1 ]
+        self.assertEqual(temp.render(count=count, ls=['a']), '[1a]')
+        self.assertEqual(temp.render(count=count, ls=['a']), '[1a]')
+        self.assertEqual(temp.render(count=count, ls=['b']), '[2b]')
+        self.assertEqual(temp.render(count=count, ls=['a']), '[1a]')
+        clearfragments(env)
+        self.assertEqual(temp.render(count=count, ls=['a']), '[3a]')
+
 class TestMarkdownExts(unittest.TestCase):
     def render(self, dat):
         mdenv = markdown.Markdown(extensions=extension_list())
@@ -28,6 +28,9 @@ class MultiDict(MutableMapping):
     def __iter__(self):
         return self.map.__iter__()
 
+    def clear(self):
+        self.map.clear()
+
     def add(self, key, val):
         if key not in self.map:
             self.map[key] = [ val ]
@@ -186,6 +189,13 @@ def relativetime(after, before, english=True):
     return 'straightaway'
 
 
+def sizestr(val):
+    if val < 1024:
+        return '%d bytes' % (val,)
+    if val < 1024*1024:
+        return '%.1f KB' % (val / 1024,)
+    return '%.1f MB' % (val / (1024*1024),)
+
 def xofypages(val, total):
     if val == 0:
         res = 'none of %d' % (total,)
@@ -0,0 +1,202 @@
+import os
+import os.path
+import time
+import traceback
+
+# How often to check for changes, in seconds.
+POLL_INTERVAL = 0.5
+
+class Watcher:
+    """Keeps a Context resident, polls the source directories, and
+    rebuilds whatever an edit affects.
+
+    Only the entries (and comment threads) which changed are re-read.
+    The entry lists and maps are then re-indexed in memory, and the
+    pages to rebuild are worked out from the build manifest, exactly
+    as in a no-arguments build.
+    """
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.templatesdir = os.path.join(ctx.opts.srcdir, 'templates')
+        _, self.stamps = self.scan()
+
+        # Paths which failed to read; we won't build until they're fixed.
+        self.broken = set()
+
+    def scan(self):
+        """Take a snapshot of the source directories. Returns (snapshot,
+        stamps), where stamps is { path: FileStat } for the files we
+        care about.
+        """
+        ctx = self.ctx
+        snapshot = Snapshot([ ctx.entriesdir, ctx.pagesdir, self.templatesdir ])
+        stamps = {}
+        for topdir, entry in [ (ctx.entriesdir, True), (ctx.pagesdir, False), (self.templatesdir, False) ]:
+            for dirpath, filenames in snapshot.walk(topdir):
+                for filename in filenames:
+                    if skipsrcfile(filename, entry=entry):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    stamps[path] = snapshot.stats[path]
+        return snapshot, stamps
+
+    def run(self):
+        print('Watching for changes (^C to stop)...')
+        try:
+            while True:
+                time.sleep(POLL_INTERVAL)
+                try:
+                    self.check()
+                except RuntimeException as ex:
+                    print('Error: %s' % (ex,))
+                except Exception:
+                    # Most likely a template error. Keep watching.
+                    traceback.print_exc()
+        except KeyboardInterrupt:
+            print()
+        if self.ctx.readcache and self.ctx.readcache.dirty:
+            self.ctx.readcache.save()
+
+    def check(self):
+        ctx = self.ctx
+        starttime = time.time()
+        if not self.refresh():
+            return
+
+        ctx.sourcerecords = None
+        ctx.orphans = []
+        ctx.generate(ctx.autopages())
+        print('Rebuilt in %.2f sec' % (time.time() - starttime,))
+
+    def refresh(self):
+        """Re-read whatever has changed since the last scan, and re-index
+        the Context. Returns True if anything changed (and was read
+        without errors).
+        """
+        ctx = self.ctx
+        snapshot, newstamps = self.scan()
+        changed = [ path for path, stamp in newstamps.items() if self.stamps.get(path) != stamp ]
+        changed.extend([ path for path in self.stamps if path not in newstamps ])
+        self.stamps = newstamps
+        if not changed:
+            return False
+        ctx.snapshot = snapshot
+
+        print('Changed: %s' % (', '.join(sorted([ os.path.relpath(path, start=ctx.opts.srcdir) for path in changed ])),))
+
+        ctx.errors = []
+        touched = set()
+        for path in changed:
+            if path.startswith(self.templatesdir+os.sep):
+                # Nothing to re-read; the manifest fingerprint will
+                # notice the template change.
+                continue
+            touched.add(path)
+        touched.update(self.broken)
+        self.broken.clear()
+
+        entryuris = set()
+        staticpaths = set()
+        for path in touched:
+            if path.startswith(ctx.entriesdir+os.sep):
+                relpath = os.path.relpath(path, start=ctx.entriesdir)
+                uri, _, _ = relpath.rpartition('.')
+                entryuris.add(uri)
+            else:
+                staticpaths.add(path)
+
+        for uri in sorted(entryuris):
+            self.rereadentry(uri)
+        for path in sorted(staticpaths):
+            self.rereadstatic(path)
+
+        if ctx.errors:
+            print('Not building until errors are fixed')
+            return False
+
+        ctx.indexentries()
+        ctx.pages = [ page for page in ctx.pages if page.path is not None ]
+        ctx.addnonsrc()
+        return True
+
+    def error(self, ex, path):
+        print('Error: %s' % (ex,))
+        self.ctx.errors.append(ex)
+        self.broken.add(path)
+
+    def rereadentry(self, uri):
+        """Re-read the entry with the given outuri, and its comments.
+        If either fails, the old versions are left in place.
+        """
+        ctx = self.ctx
+        oldentry = ctx.entriesbyuri.get(uri)
+        oldcomt = (oldentry.commentthread if oldentry else None)
+
+        entrypath = None
+        commentspath = None
+        for path in self.stamps:
+            if not path.startswith(ctx.entriesdir+os.sep):
+                continue
+            relpath = os.path.relpath(path, start=ctx.entriesdir)
+            val, _, suffix = relpath.rpartition('.')
+            if val != uri:
+                continue
+            if suffix == 'comments':
+                commentspath = path
+            else:
+                entrypath = path
+
+        entry = None
+        comt = None
+        try:
+            if entrypath:
+                entry = EntryPage(ctx, *os.path.split(entrypath))
+            if commentspath:
+                comt = CommentThread(ctx, *os.path.split(commentspath))
+                if entry is None:
+                    raise RuntimeException('comments file has no entry: '+comt.outuri)
+                entry.commentthread = comt
+                comt.entry = entry
+            if entry:
+                entry.read()
+            if comt:
+                comt.read()
+        except RuntimeException as ex:
+            self.error(ex, entrypath or commentspath)
+            return
+
+        if oldentry:
+            ctx.pages.remove(oldentry)
+            ctx.entries.remove(oldentry)
+            del ctx.entriesbyuri[uri]
+        if oldcomt:
+            ctx.commentthreads.remove(oldcomt)
+        if entry:
+            ctx.pages.append(entry)
+            ctx.entries.append(entry)
+            ctx.entriesbyuri[uri] = entry
+        if comt:
+            ctx.commentthreads.append(comt)
+
+    def rereadstatic(self, path):
+        ctx = self.ctx
+        oldls = [ page for page in ctx.pages if page.path == path ]
+        page = None
+        if path in self.stamps:
+            try:
+                page = StaticPage(ctx, *os.path.split(path))
+                page.read()
+            except RuntimeException as ex:
+                self.error(ex, path)
+                return
+        for oldpage in oldls:
+            ctx.pages.remove(oldpage)
+        if page:
+            ctx.pages.append(page)
+
+
+from bloggor.excepts import RuntimeException
+from bloggor.pages import EntryPage, StaticPage
+from bloggor.comments import CommentThread
+from bloggor.context import skipsrcfile
+from bloggor.scan import Snapshot
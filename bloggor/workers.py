@@ -0,0 +1,103 @@
+import traceback
+import multiprocessing
+import concurrent.futures
+import markdown
+
+# Worker processes are forked from the main process. We never use the
+# "spawn" start method, because build.py is not import-safe; if fork is
+# not available, the caller falls back to doing the work serially.
+
+def canfork():
+    return ('fork' in multiprocessing.get_all_start_methods())
+
+# The Markdown instance belonging to this worker process.
+worker_mdenv = None
+
+def initreadworker(serverurl):
+    global worker_mdenv
+    extlist = bloggor.mdextension.extension_list(serverurl=serverurl)
+    worker_mdenv = markdown.Markdown(extensions=extlist)
+
+def readsourcetask(args):
+    path, type = args
+    try:
+        return (readsourcefile(path, type, worker_mdenv), None)
+    except RuntimeException as ex:
+        return (None, ex)
+
+def readcommentstask(args):
+    path, outuri = args
+    return readcommentfile(path, outuri, worker_mdenv)
+
+def readpool(jobs, serverurl):
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers = jobs,
+        mp_context = multiprocessing.get_context('fork'),
+        initializer = initreadworker,
+        initargs = (serverurl,),
+    )
+
+# The Context, as inherited from the parent process by forking.
+worker_ctx = None
+
+def initbuildworker():
+    # Each worker gets a fresh Jinja environment, set up the same way
+    # as the parent's.
+    ctx = worker_ctx
+    ctx.jenv = ctx.createjenv()
+    for page in ctx.pages:
+        page.jenv = ctx.jenv
+
+def buildtask(ixls):
+    """Build the pages with the given indexes (in ctx.pages). Returns
+    (error, results): error is None on success, or a description of
+    the failure; results is a list of (ix, written, outsize) for the
+    pages that were built.
+    """
+    results = []
+    for ix in ixls:
+        page = worker_ctx.pages[ix]
+        try:
+            page.build()
+        except Exception as ex:
+            return ('Error building %r:\n%s' % (page, traceback.format_exc(),), results)
+        results.append( (ix, page.written, page.outsize) )
+    return (None, results)
+
+def buildpool(jobs, ctx):
+    global worker_ctx
+    # Set this before the pool forks its workers.
+    worker_ctx = ctx
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers = jobs,
+        mp_context = multiprocessing.get_context('fork'),
+        initializer = initbuildworker,
+    )
+
+def compresstask(args):
+    path, encodings, oldhash = args
+    return processoutput(path, encodings, oldhash)
+
+def compresspool(jobs):
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers = jobs,
+        mp_context = multiprocessing.get_context('fork'),
+    )
+
+def partition(ls, count):
+    """Split a list into (at most) count interleaved chunks. Interleaving
+    spreads out runs of similar (and similarly expensive) pages.
+    """
+    count = max(1, min(count, len(ls)))
+    return [ ls[ix::count] for ix in range(count) ]
+
+def chunksize(count, jobs):
+    # A few chunks per worker, so that slow files even out.
+    return max(1, count // (jobs * 4))
+
+
+import bloggor.mdextension
+from bloggor.excepts import RuntimeException
+from bloggor.pages import readsourcefile
+from bloggor.comments import readcommentfile
+from bloggor.compress import processoutput
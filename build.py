@@ -7,6 +7,7 @@ import datetime
 import optparse
 
 import bloggor.context
+import bloggor.watch
 from bloggor.excepts import RuntimeException
 
 popt = optparse.OptionParser(usage='build.py [options] [pages...]')
@@ -20,6 +21,15 @@ popt.add_option('--config',
 popt.add_option('-o', '--out',
                 action='store', dest='destdir', default='site',
                 help='destination directory')
+popt.add_option('--cachedir',
+                action='store', dest='cachedir',
+                help='cache directory (default: srcdir/.bloggor-cache)')
+popt.add_option('--nocache',
+                action='store_true', dest='nocache',
+                help='do not use or update the cache of converted source files')
+popt.add_option('-j', '--jobs',
+                action='store', type='int', dest='jobs', default=1,
+                help='number of worker processes for reading and building (default: 1)')
 popt.add_option('-a', '--all',
                 action='store_true', dest='buildall',
                 help='build all files')
@@ -32,6 +42,12 @@ popt.add_option('--only',
 popt.add_option('-l', '--long',
                 action='store_true', dest='longlist',
                 help='list all pages built, even if there\'s lots')
+popt.add_option('-w', '--watch',
+                action='store_true', dest='watch',
+                help='after building, watch for changes and rebuild')
+popt.add_option('--atomic',
+                action='store_true', dest='atomic',
+                help='build into a new copy of the output directory, and publish it with a single symlink swap')
 popt.add_option('--dry', '--dryrun',
                 action='store_true', dest='dryrun',
                 help='read source but do not generate')
@@ -47,6 +63,12 @@ popt.add_option('--notemp',
 
 ctx = bloggor.context.Context(opts)
 
+watcher = None
+if opts.watch:
+    # Start watching before the first build, so that we don't miss
+    # changes made while it runs.
+    watcher = bloggor.watch.Watcher(ctx)
+
 tup = datetime.datetime.now(datetime.timezone.utc)
 val, _, _ = tup.isoformat().partition('.')
 val += 'Z'
@@ -65,4 +87,7 @@ if not success:
 else:
     print('Done.')
 
+if watcher and success:
+    watcher.run()
+
 
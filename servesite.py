@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 
-import os.path
+import sys
+import io
+import socket
 import argparse
 import contextlib
+import traceback
 import http.server
 from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
 
+from bloggor.serving import FileSite, CachePolicy, parsecachecontrol
+
 parser = argparse.ArgumentParser()
 
 parser.add_argument('-b', '--bind', metavar='ADDRESS',
@@ -15,9 +20,21 @@ parser.add_argument('-d', '--directory', default='site',
                     help='serve this directory '
                     '(default: current directory)')
 parser.add_argument('-p', '--protocol', metavar='VERSION',
-                    default='HTTP/1.0',
+                    default='HTTP/1.1',
                     help='conform to this HTTP version '
                     '(default: %(default)s)')
+parser.add_argument('--live', metavar='SRCDIR',
+                    help='render pages on request from this source directory, '
+                    'rather than serving built files')
+parser.add_argument('--config', dest='configfile', metavar='FILE',
+                    help='config file (with --live; default: SRCDIR/bloggor.cfg)')
+parser.add_argument('--async', dest='asyncmode', action='store_true',
+                    help='use an asyncio server, with sendfile and an in-memory '
+                    'cache of small pages (for load testing)')
+parser.add_argument('--cache-control', dest='cachecontrol', metavar='PREFIX=VALUE',
+                    action='append', default=[],
+                    help='send this Cache-Control header for paths starting with '
+                    'PREFIX (may be repeated; an empty PREFIX sets the default)')
 parser.add_argument('port', default=8001, type=int, nargs='?',
                     help='bind to this port '
                     '(default: %(default)s)')
@@ -26,12 +43,45 @@ args = parser.parse_args()
 
 
 class CleanHTTPRequestHandler(SimpleHTTPRequestHandler):
-    def translate_path(self, path):
-        res = SimpleHTTPRequestHandler.translate_path(self, path)
-        if not os.path.exists(res) and not path.endswith('/'):
-            if os.path.exists(res+'.html'):
-                res += '.html'
-        return res
+    def send_head(self):
+        # The FileSite does the work: clean URLs, compressed siblings,
+        # ETags, and conditional requests.
+        res = filesite.respond(self.path, self.headers)
+        if res.status == 404:
+            self.send_error(404, 'File not found')
+            return None
+        fl = None
+        size = 0
+        if res.status == 200:
+            try:
+                fl, size = filesite.openbody(res)
+            except OSError:
+                self.send_error(404, 'File not found')
+                return None
+        self.send_response(res.status)
+        for key, val in res.headers:
+            self.send_header(key, val)
+        if res.status != 304:
+            self.send_header('Content-Length', str(size))
+        self.end_headers()
+        return fl
+
+class LiveHTTPRequestHandler(CleanHTTPRequestHandler):
+    def send_head(self):
+        try:
+            res = livesite.get(self.path)
+        except Exception as ex:
+            traceback.print_exc()
+            self.send_error(500, 'Error rendering page: %s' % (ex,))
+            return None
+        if res is None:
+            return CleanHTTPRequestHandler.send_head(self)
+        outpath, data = res
+        self.send_response(200)
+        self.send_header('Content-type', self.guess_type(outpath))
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        return io.BytesIO(data)
 
 # ensure dual-stack is not disabled; ref #38907
 class DualStackServer(ThreadingHTTPServer):
@@ -47,10 +97,33 @@ class DualStackServer(ThreadingHTTPServer):
             self.RequestHandlerClass(request, client_address, self,
                                      directory=args.directory)
 
+if args.asyncmode and args.live:
+    parser.error('--async cannot be used with --live')
+
+try:
+    cachepolicy = CachePolicy(parsecachecontrol(args.cachecontrol))
+except ValueError as ex:
+    parser.error(str(ex))
+filesite = FileSite(args.directory, cachepolicy)
+
+handler = CleanHTTPRequestHandler
+livesite = None
+if args.live:
+    from bloggor.context import Context, defaultopts
+    from bloggor.livesite import LiveSite
+    opts = defaultopts(srcdir=args.live, destdir=args.directory, configfile=args.configfile, nocache=True)
+    livesite = LiveSite(Context(opts))
+    handler = LiveHTTPRequestHandler
+
 print("http://localhost:%d/" % (args.port,))
 
+if args.asyncmode:
+    import bloggor.aserve
+    bloggor.aserve.run(filesite, args.bind, args.port)
+    sys.exit(0)
+
 http.server.test(
-    HandlerClass=CleanHTTPRequestHandler,
+    HandlerClass=handler,
     ServerClass=DualStackServer,
     port=args.port,
     bind=args.bind,